@@ -12,9 +12,22 @@ from time import sleep
 
 import logging
 import os
+import sqlite3
+import threading
 
 
 class BenchmarkDb():
+    """Benchmark samples in an indexed sqlite database inside directory.
+
+    Samples are keyed by gpu uuid, algorithm, miner version and overclock
+    (power, gpu clock, memory clock offsets). A missing offset is stored as
+    0, so the offset index serves exact lookups.
+    """
+
+    FILENAME = "benchmark.sqlite"
+    OFFSET_COLUMNS = ["power_offset", "gpu_clock_offset", "mem_clock_offset"]
+    COLUMNS = ["algo", "gpu_uuid", "miner", "miner_version", "hashrate", "power_offset", "gpu_clock_offset", "mem_clock_offset", "success", "length", "confidence"]
+
     def __init__(self, directory):
         self.directory = directory
 
@@ -24,18 +37,170 @@ class BenchmarkDb():
         self.logger = logging.getLogger()
         self.logger.debug("Using db: %s", self.directory)
 
-    def _filepath(self, algo, gpu_uuid, miner, miner_version):
-        filename = "%s_%s_%s_%s.csv" % (algo, miner, miner_version, gpu_uuid)
-        filepath = self.directory + "/" + filename
-        return filepath
+        self.filename = os.path.join(self.directory, self.FILENAME)
+        created = not os.path.exists(self.filename)
+
+        # Shared by the benchmark threads, all access goes through self.lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self._create_schema()
+
+        # Carry over samples from the csv files older versions wrote
+        if created:
+            imported = self.import_csv(self.directory)
+            if imported:
+                self.logger.info("Imported %d samples from csv files in %s", imported, self.directory)
+
+    def _create_schema(self):
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS samples (
+                    id INTEGER PRIMARY KEY,
+                    time REAL,
+                    algo TEXT NOT NULL,
+                    gpu_uuid TEXT NOT NULL,
+                    miner TEXT,
+                    miner_version TEXT,
+                    hashrate REAL,
+                    power_offset REAL,
+                    gpu_clock_offset REAL,
+                    mem_clock_offset REAL,
+                    success INTEGER,
+                    length REAL,
+                    confidence REAL
+                )""")
+            # Databases created before the confidence column was added
+            columns = [row["name"] for row in self.conn.execute("PRAGMA table_info(samples)")]
+            if "confidence" not in columns:
+                self.conn.execute("ALTER TABLE samples ADD COLUMN confidence REAL")
+            # Databases that stored missing offsets as NULL
+            if self.conn.execute("PRAGMA user_version").fetchone()[0] < 1:
+                for column in self.OFFSET_COLUMNS:
+                    self.conn.execute("UPDATE samples SET %s = 0 WHERE %s IS NULL" % (column, column))
+                self.conn.execute("PRAGMA user_version = 1")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS samples_best ON samples (gpu_uuid, algo, success, hashrate)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS samples_oc ON samples (gpu_uuid, algo, power_offset, gpu_clock_offset, mem_clock_offset)")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def save(self, algo, gpu_uuid, miner, miner_version, hashrate, power_offset, gpu_clock_offset, mem_clock_offset, success, length, confidence=None):
+        """confidence -- relative 95% confidence interval of the hashrate, if known"""
+        self.save_many([(algo, gpu_uuid, miner, miner_version, hashrate, power_offset, gpu_clock_offset, mem_clock_offset, success, length, confidence)])
+
+    def save_many(self, samples):
+        """Saves a list of tuples with the arguments of save() in one transaction."""
+        now = time.time()
+        rows = [(now,) + tuple(s[:5]) + tuple(x or 0 for x in s[5:8]) + (1 if s[8] else 0, s[9], s[10] if len(s) > 10 else None) for s in samples]
+        self.logger.debug("Writing: %s", str(rows))
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT INTO samples (time, " + ", ".join(self.COLUMNS) + ") VALUES (?" + ", ?" * len(self.COLUMNS) + ")", rows)
+
+    def _query(self, sql, params):
+        with self.lock:
+            return [dict(row) for row in self.conn.execute(sql, params)]
+
+    def _filter(self, gpu_uuid=None, algo=None, miner_version=None):
+        clauses = []
+        params = []
+        for column, value in [("gpu_uuid", gpu_uuid), ("algo", algo), ("miner_version", miner_version)]:
+            if value is not None:
+                clauses.append(column + " = ?")
+                params.append(value)
+        return clauses, params
+
+    def samples(self, gpu_uuid=None, algo=None, miner_version=None, success=None):
+        """Returns all samples matching the given keys, oldest first."""
+        clauses, params = self._filter(gpu_uuid, algo, miner_version)
+        if success is not None:
+            clauses.append("success = ?")
+            params.append(1 if success else 0)
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        return self._query("SELECT * FROM samples" + where + " ORDER BY id", params)
+
+    def best(self, gpu_uuid, algo=None, miner_version=None):
+        """Returns dict of algo -> successful sample with the highest hashrate for the gpu."""
+        clauses, params = self._filter(gpu_uuid, algo, miner_version)
+        clauses.append("success = 1")
+        rows = self._query("SELECT *, MAX(hashrate) FROM samples WHERE " + " AND ".join(clauses) + " GROUP BY algo", params)
+        out = {}
+        for row in rows:
+            del row["MAX(hashrate)"]
+            out[row["algo"]] = row
+        return out
+
+    def near(self, gpu_uuid, algo, power_offset, gpu_clock_offset, mem_clock_offset, power_tolerance=0, clock_tolerance=0, mem_tolerance=0, miner_version=None):
+        """Returns all samples whose overclock is within the tolerances of the given point."""
+        clauses, params = self._filter(gpu_uuid, algo, miner_version)
+        for column, value, tolerance in [
+                ("power_offset", power_offset, power_tolerance),
+                ("gpu_clock_offset", gpu_clock_offset, clock_tolerance),
+                ("mem_clock_offset", mem_clock_offset, mem_tolerance)]:
+            # Equality keeps the following index columns usable
+            if tolerance == 0:
+                clauses.append("%s = ?" % (column))
+                params.append(value or 0)
+            else:
+                clauses.append("%s BETWEEN ? AND ?" % (column))
+                params += [(value or 0) - tolerance, (value or 0) + tolerance]
+        return self._query("SELECT * FROM samples WHERE " + " AND ".join(clauses) + " ORDER BY id", params)
+
+    def import_csv(self, directory):
+        """Imports the per (algo, miner, version, uuid) csv files of older versions, returns the sample count."""
+
+        def number(val):
+            val = val.strip()
+            return None if val in ("", "None") else float(val)
+
+        samples = []
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith(".csv"):
+                continue
+            # Algorithm names may contain underscores, the other fields do not
+            parts = filename[:-len(".csv")].rsplit("_", 3)
+            if len(parts) != 4:
+                self.logger.warning("Skipping unrecognized file: %s", filename)
+                continue
+            algo, miner, miner_version, gpu_uuid = parts
+
+            with open(os.path.join(directory, filename)) as fd:
+                for line in fd:
+                    fields = line.split(",")
+                    if len(fields) != 6:
+                        continue
+                    success, hashrate, power, clock, mem, length = [number(x) for x in fields]
+                    samples.append((algo, gpu_uuid, miner, miner_version, hashrate, power, clock, mem, success == 1, length))
+
+        if samples:
+            self.save_many(samples)
+        return len(samples)
+
+
+if(__name__ == "__main__"):
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(filename)-20.20s:%(lineno)4d] [%(levelname)-5.5s] %(message)s",
+        handlers=[
+            logging.StreamHandler(sys.stdout)
+        ])
+
+    import argparse
+    parser = argparse.ArgumentParser(description='Query or import into a benchmark db')
+
+    parser.add_argument("db", help='db directory')
+    parser.add_argument("--import-csv", help='import csv files from directory')
+    parser.add_argument("--best", help='print best sample per algorithm for gpu uuid')
 
-    def save(self, algo, gpu_uuid, miner, miner_version, hashrate, power_offset, gpu_clock_offset, mem_clock_offset, success, length):
-        
-        filepath = self._filepath(algo, gpu_uuid, miner, miner_version)
-        with open(filepath, "a+") as fd:
-            csv = ", ".join([str(x) for x in [1 if success else 0, hashrate, power_offset, gpu_clock_offset, mem_clock_offset, length]])
-            self.logger.debug("Writing: %s", csv)
-            fd.write(csv + "\n")
+    args = parser.parse_args()
 
+    db = BenchmarkDb(args.db)
 
+    if args.import_csv:
+        print("Imported %d samples" % (db.import_csv(args.import_csv)))
 
+    if args.best:
+        for algo, sample in sorted(db.best(args.best).items()):
+            print("%-24s %16.1f H/s  power: %s, clock: %s, mem: %s" % (algo, sample["hashrate"], sample["power_offset"], sample["gpu_clock_offset"], sample["mem_clock_offset"]))
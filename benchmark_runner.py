@@ -4,6 +4,8 @@ import re
 import json
 import tempfile
 import subprocess
+import collections
+import threading
 
 import excavator_benchmark
 import excavator_api
@@ -11,6 +13,8 @@ import overclock
 import overclock_session
 import benchmark_db
 import nvidia_smi
+import oc_search
+from oc_search import parse_range, frange
 
 algorithms = [
     "equihash",
@@ -29,67 +33,364 @@ algorithms = [
     ]
 
 
-def generate_tasks_oc_range(device, algos, benchmark_length, clock_range, power_range, mem_range):
+def generate_tasks_oc_range(device, algos, benchmark_length, clock_range, power_range, mem_range, tolerance=None):
 
     tasks = []
     for a in algos:
         for p in power_range:
             for c in clock_range:
                 for m in mem_range:
-                    tasks.append(excavator_benchmark.Benchmark(device, a, benchmark_length, overclock_session.OcSpec(c, m, p)))
+                    tasks.append(excavator_benchmark.Benchmark(device, a, benchmark_length, overclock_session.OcSpec(c, m, p), tolerance))
     
     return tasks
 
-def generate_tasks_oc_file(device, algos, benchmark_length, file):
+def generate_tasks_oc_file(device, algos, benchmark_length, file, tolerance=None):
 
     tasks = []
     uuid = nvidia_smi.device(device)["uuid"]
     for a in algos:
         os = overclock_session.OcStrategyFile(uuid, a, file)
-        tasks.append(excavator_benchmark.Benchmark(device, a, benchmark_length, os.get_spec()))
+        tasks.append(excavator_benchmark.Benchmark(device, a, benchmark_length, os.get_spec(), tolerance))
     
     return tasks
 
-def run_benchmark(task: excavator_benchmark.Benchmark):
+def run_search(device, algo, benchmark_length, dimensions, db, on_result, tolerance=None, excavator=None, watch=None):
+    """Searches the overclock space of one algorithm adaptively instead of running a grid.
+
+    Earlier samples in db are reused, points more aggressive than a crashed
+    one count as crashed. on_result is called with every finished task.
+    """
+
+    uuid = nvidia_smi.device(device)["uuid"]
+    lookup = oc_search.db_lookup(db, uuid, algo) if db else None
+    search = oc_search.CoordinateSearch(dimensions, lookup=lookup)
+
+    while True:
+        spec = search.propose()
+        if spec is None:
+            break
+        task = excavator_benchmark.Benchmark(device, algo, benchmark_length, spec, tolerance)
+        logging.info("Search  (%s, %d run): %s", algo, search.evaluations + 1, str(task))
+        if watch:
+            watch.track(task)
+        run_benchmark(task, excavator)
+        if watch:
+            watch.untrack(task)
+        search.report(spec, task.result[0])
+        on_result(task)
+
+    best, hashrate = search.best()
+    logging.info("Search for %s finished after %d benchmarks (%d reused from db), best: %s H/s at %s", algo, search.evaluations, search.reused, str(hashrate), best)
+
+def run_benchmark(task: excavator_benchmark.Benchmark, excavator=None):
 
     dev = overclock.Device(task.device)
     dev.refresh()
 
     task.dev_uuid = dev.get_uuid()
 
-    task.result = excavator_benchmark.run_benchmark(task)
+    # Record the overclock the benchmark runs with
+    task.dev_power = task.oc_spec.power
+    task.dev_clock = task.oc_spec.gpu_clock
+    task.dev_mem = task.oc_spec.mem_clock
+
+    task.result = excavator_benchmark.run_benchmark(task, excavator=excavator)
         
     dev.refresh()
 
     task.dev_temp = dev.get_temp()
 
 
-def parse_range(spec):
-
-    r_float = '[+-]?[0-9]*\.[0-9]+|[+-]?[0-9]+'
-    m_scalar = re.match(r"("+r_float+")", spec)
-    m_range = re.match(r"\[("+r_float+"):?("+r_float+")?:?("+r_float+")?\]", spec)
-
-    if(m_scalar):
-        return [float(m_scalar.group(1))]
-    elif(m_range):
-        first = float(m_range.group(1))
-        step = 1
-        last = first
-        if(m_range.group(3)):
-            last = float(m_range.group(3))
-            step = float(m_range.group(2))
-        elif(m_range.group(2)):
-            last = float(m_range.group(2))
-        return list(frange(first, last, step))
-    else:
-        raise Exception("Could not parse range: %s" % (spec))
-            
-def frange(x, y, jump):
-    while x < y:
-        yield x
-        x += jump
-    yield y
+class Checkpoint():
+    """Manifest of the tasks in a suite and the results of finished ones.
+
+    Saved when a task starts and finishes, so an interrupted suite can be
+    resumed without running finished tasks again. A task still marked as
+    running was interrupted by a crash of the whole system, which overclock
+    sweeps cause by design, and is recorded as crashed on resume.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.tasks = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.tasks = dict((t["key"], t) for t in json.load(f)["tasks"])
+
+    @staticmethod
+    def key(task):
+        device = "any" if task.device is None else str(task.device)
+        return "|".join([device, task.algo, str(task.oc_spec.power), str(task.oc_spec.gpu_clock), str(task.oc_spec.mem_clock)])
+
+    def add(self, task):
+        key = self.key(task)
+        if key not in self.tasks:
+            self.tasks[key] = {
+                "key": key,
+                "device": task.device,
+                "algo": task.algo,
+                "power": task.oc_spec.power,
+                "gpu_clock": task.oc_spec.gpu_clock,
+                "mem_clock": task.oc_spec.mem_clock,
+                "status": "pending"
+            }
+        task.key = key
+
+    def finished(self, task):
+        """Returns the stored entry if task finished in an earlier run, else None."""
+        entry = self.tasks.get(self.key(task))
+        if entry and entry["status"] != "pending":
+            return entry
+        return None
+
+    def restore(self, task, entry):
+        task.key = entry["key"]
+        if entry["status"] == "running":
+            task.device = entry["running_device"]
+            task.dev_uuid = entry["dev_uuid"]
+            task.dev_power = task.oc_spec.power
+            task.dev_clock = task.oc_spec.gpu_clock
+            task.dev_mem = task.oc_spec.mem_clock
+            task.result = [0.0]
+            task.crashed = True
+            return
+        task.device = entry["device"]
+        task.result = entry["result"]
+        task.crashed = entry["status"] == "crashed"
+        for attr in ["dev_uuid", "dev_power", "dev_clock", "dev_mem", "dev_temp", "length", "confidence"]:
+            setattr(task, attr, entry[attr])
+
+    def start(self, task):
+        with self.lock:
+            entry = self.tasks[task.key]
+            entry["status"] = "running"
+            entry["running_device"] = task.device
+            entry["dev_uuid"] = nvidia_smi.device(task.device)["uuid"]
+            self.save()
+
+    def done(self, task):
+        with self.lock:
+            entry = self.tasks[task.key]
+            entry["status"] = "crashed" if task.crashed else "done"
+            entry["result"] = task.result
+            for attr in ["dev_uuid", "dev_power", "dev_clock", "dev_mem", "dev_temp", "length", "confidence"]:
+                entry[attr] = getattr(task, attr)
+            self.save()
+
+    def pruned(self, task):
+        with self.lock:
+            self.tasks[task.key]["status"] = "pruned"
+            self.save()
+
+    def save(self):
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"tasks": list(self.tasks.values())}, f, indent=1)
+        os.rename(tmp, self.filename)
+
+
+def restore_from_db(db, uuids, task):
+    """Restores the result of task from db, like Checkpoint.restore(), if db
+    has a sample of it on one of the gpus or a crashed sample that task is
+    more aggressive than. Returns False if the task has to run.
+
+    uuids -- dict of device number -> gpu uuid
+    """
+    spec = task.oc_spec
+    for device, uuid in uuids.items():
+        samples = db.near(uuid, task.algo, spec.power, spec.gpu_clock, spec.mem_clock)
+        crashed = any(not s["success"] for s in samples) or \
+            any(oc_search.more_aggressive(spec, c) for c in oc_search.crashed_specs(db, uuid, task.algo))
+        if not samples and not crashed:
+            continue
+
+        task.device = device
+        task.dev_uuid = uuid
+        task.dev_power = spec.power
+        task.dev_clock = spec.gpu_clock
+        task.dev_mem = spec.mem_clock
+        task.crashed = crashed
+        if crashed:
+            task.result = [0.0]
+        else:
+            task.result = [sum(s["hashrate"] for s in samples) / len(samples)]
+            task.length = samples[-1]["length"]
+            task.confidence = samples[-1]["confidence"]
+        return True
+    return False
+
+
+class CrashWatch():
+    """Attributes gpu crashes (xid events from nvidia_smi.Monitor) to the
+    benchmark running on the gpu, by setting its xid.
+
+    on_crash is called with the task, from the monitor thread.
+    """
+
+    # 43 is the crash itself. The recovery (45) follows it, often after the
+    # crashed task was untracked, and would be blamed on the next task.
+    CRASH_XIDS = [43]
+
+    def __init__(self, devices, on_crash=None):
+        self.on_crash = on_crash
+        self.devices = devices
+        self.lock = threading.Lock()
+        self.running = {}
+        # nvidia-smi stats does not take a device list, watch all and filter
+        self.monitor = nvidia_smi.Monitor(data=["xidEvent"], sink=self.event)
+
+    def start(self):
+        self.monitor.start()
+
+    def stop(self):
+        self.monitor.stop()
+
+    def track(self, task):
+        with self.lock:
+            self.running[task.device] = task
+
+    def untrack(self, task):
+        with self.lock:
+            if self.running.get(task.device) is task:
+                del self.running[task.device]
+
+    def event(self, event):
+        if event["type"] != "xidEvent" or event["value"] not in self.CRASH_XIDS:
+            return
+        if event["id"] not in self.devices:
+            return
+        with self.lock:
+            task = self.running.get(event["id"])
+            if task is None or task.xid is not None:
+                return
+            task.xid = event["value"]
+        logging.error("Gpu %d crashed (xid: %d) running %s", event["id"], event["value"], str(task))
+        if self.on_crash:
+            self.on_crash(task)
+
+
+class Scheduler():
+    """Runs benchmark tasks on several devices in parallel under one excavator instance.
+
+    Tasks with a device set are pinned to it, tasks with device None go to
+    whichever device is free first, so devices finishing short tasks pick
+    up more of the remaining work. on_result is called (serialized) with
+    every finished task. A crashed task is retried once, since with several
+    devices running the crash may have been caused by another device,
+    unless a CrashWatch attributed the crash to it. In that case the queued
+    tasks that are more aggressive than the crashed one are pruned, and
+    on_pruned is called with each of them.
+    """
+
+    RETRIES = 1
+
+    def __init__(self, devices, excavator, on_result, on_start=None, watch=None, on_pruned=None):
+        self.devices = devices
+        self.excavator = excavator
+        self.on_result = on_result
+        self.on_start = on_start
+        self.on_pruned = on_pruned
+        self.watch = watch
+        if watch:
+            watch.on_crash = self.prune
+
+        self.lock = threading.Lock()
+        self.shared = collections.deque()
+        self.pinned = dict((d, collections.deque()) for d in devices)
+        self.total = 0
+        self.done = 0
+        self.pruned = 0
+
+    def add(self, task):
+        task.attempts = 0
+        task.pinned = task.device is not None
+        self.total += 1
+        self._put(task)
+
+    def _put(self, task):
+        with self.lock:
+            if task.pinned:
+                self.pinned[task.device].append(task)
+            else:
+                self.shared.append(task)
+
+    def _next(self, device):
+        with self.lock:
+            for q in [self.pinned[device], self.shared]:
+                if q:
+                    return q.popleft()
+        return None
+
+    def prune(self, crashed):
+        """Drops queued tasks of the crashed task's algorithm that are more aggressive than it."""
+        pruned = []
+        with self.lock:
+            queues = [self.shared, self.pinned[crashed.device]]
+            for q in queues:
+                keep = []
+                for t in q:
+                    if t.algo == crashed.algo and oc_search.more_aggressive(t.oc_spec, crashed.oc_spec):
+                        pruned.append(t)
+                    else:
+                        keep.append(t)
+                q.clear()
+                q.extend(keep)
+            self.done += len(pruned)
+            self.pruned += len(pruned)
+
+        if pruned:
+            logging.info("Pruned %d bechmarks more aggressive than %s", len(pruned), str(crashed))
+        for t in pruned:
+            if self.on_pruned:
+                self.on_pruned(t)
+
+    def _worker(self, device):
+        while True:
+            task = self._next(device)
+            if task is None:
+                return
+
+            task.device = device
+            task.attempts += 1
+            if self.on_start:
+                self.on_start(task)
+            if self.watch:
+                self.watch.track(task)
+            with self.lock:
+                done = self.done
+            logging.info("Task   [gpu %d] (%d/%d): %s", device, done + 1, self.total, str(task))
+            try:
+                run_benchmark(task, self.excavator)
+            except Exception:
+                # Keep the worker alive for the remaining tasks of the device
+                logging.exception("Task   [gpu %d] failed: %s", device, str(task))
+                task.crashed = True
+                task.result = [0.0]
+            finally:
+                if self.watch:
+                    self.watch.untrack(task)
+
+            if task.crashed and task.xid is None and task.attempts <= self.RETRIES and len(self.devices) > 1:
+                logging.warning("Task   [gpu %d] crashed, retrying: %s", device, str(task))
+                task.crashed = False
+                task.setup_time = None
+                self._put(task)
+                continue
+
+            with self.lock:
+                self.done += 1
+                logging.info("Result [gpu %d] (%d/%d): %s H/s, setup: %.1f s%s", device, self.done, self.total, ", ".join(str(x) for x in task.result), task.setup_time or 0.0, " (crashed)" if task.crashed else "")
+                self.on_result(task)
+
+    def run(self):
+        """Runs all added tasks, returns when they are finished."""
+        threads = [threading.Thread(target=self._worker, args=(d,), name="gpu%d" % (d)) for d in self.devices]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
 
 def greater(a, b):
     return a[0] > b[0]
@@ -108,8 +409,10 @@ if(__name__ == "__main__"):
     parser = argparse.ArgumentParser(description='Run a single excavator benchmark')
 
     parser.add_argument("--algorithms", '-a', help='algorithms, comma separated (or "all")', required = True)
-    parser.add_argument("--device", "-d", help='device number (default: 0)', default = 0, type=int)
+    parser.add_argument("--device", "-d", help='device numbers, comma separated (default: 0)', default = "0")
+    parser.add_argument("--distribute", help='run every task once on the first free device instead of on all devices', action='store_true')
     parser.add_argument("--length", '-l', help='length [s] (default: 100)', default = 100, type=int)
+    parser.add_argument("--tolerance", '-t', help='end each benchmark when the 95%% confidence interval is within this ratio of the mean, example: 0.005', default = None, type=float)
     parser.add_argument("--excavator-path", '-e', help='path to excavator executable (default: excavator)', default="excavator")
 
     parser.add_argument("--overclock-file", "-f", help="overclocing spec file for file strategy")
@@ -117,12 +420,15 @@ if(__name__ == "__main__"):
     parser.add_argument("--clock-range", '-c', help='gpu clock offset value/range, example: [-50:10:150]')
     parser.add_argument("--mem-range", '-m', help='memory clock offset value/range, example: [200:10:300]')
     parser.add_argument("--power-range", '-p', help='power limit value/range, example: [200:10:300]')
+    parser.add_argument("--search", help='search the clock/mem/power ranges adaptively instead of running the full grid', action='store_true')
 
 
 
     parser.add_argument("--csv", '-s', help='output comma separated data file')
     parser.add_argument("--json", '-j', help='output json file suitable for excavator driver')
     parser.add_argument("--db", '-b', help='output to directory db')
+    parser.add_argument("--checkpoint", '-k', help='task manifest file, updated after every finished task')
+    parser.add_argument("--resume", '-r', help='skip tasks finished in the checkpoint or present in the db (including crashed ones)', action='store_true')
 
     args = parser.parse_args()
 
@@ -130,18 +436,20 @@ if(__name__ == "__main__"):
         logger.error("Cannot specify boh overlocking file and range")
         sys.exit(0)
 
+    if args.search and args.overclock_file:
+        logger.error("Cannot search when using an overclocking file")
+        sys.exit(0)
+
     clock_range = parse_range(args.clock_range) if args.clock_range != None else [None]
     power_range = parse_range(args.power_range) if args.power_range != None else [None]
     mem_range = parse_range(args.mem_range) if args.mem_range != None else [None]
 
     algos = algorithms if args.algorithms == "all" else args.algorithms.split(",")
+    devices = [int(d) for d in args.device.split(",")]
 
-    if args.overclock_file:
-        tasks = generate_tasks_oc_file(args.device, algos, args.length, args.overclock_file)
-    else:
-        tasks = generate_tasks_oc_range(args.device, algos, args.length, clock_range, power_range, mem_range)
-
-    logger.info("Running %d bechmarks, with estimated total execution time: %.1f min", len(tasks), float(len(tasks) * (args.length+4))/ 60.0)
+    if args.distribute and (args.search or args.overclock_file):
+        logger.error("Cannot distribute search or overclocking file tasks, they are per device")
+        sys.exit(0)
 
     db = None
     if(args.db):
@@ -149,24 +457,118 @@ if(__name__ == "__main__"):
 
     output = ""
     top = {}
-    progress = 1
-    for t in tasks:
-        logger.info("Task   (%d/%d): %s", progress, len(tasks), str(t))
-        run_benchmark(t)
-        logger.info("Result (%d/%d): %s H/s", progress, len(tasks), ", ".join(str(x) for x in t.result))
+    setup_total = 0.0
+
+    checkpoint = Checkpoint(args.checkpoint) if args.checkpoint else None
+
+    def record(t, save=True):
+        global output, setup_total
+
         output = output + t.csv() + "\n"
+        setup_total += t.setup_time or 0.0
 
-        if(not t.algo in top or top[t.algo] > t.result[0]):
+        if(not t.crashed and (not t.algo in top or top[t.algo] > t.result[0])):
             top[t.algo] = t.result[0] if len(t.result) == 1 else t.result
-            
-        progress = progress + 1
+
+        if not save:
+            return
+
+        if checkpoint and hasattr(t, "key"):
+            checkpoint.done(t)
 
         if db:
             if len(t.result) > 1:
                 raise Exception("Multi algo not supported by BenchmarkDb")
 
             # TODO read miner and version
-            db.save(t.algo, t.dev_uuid, "excavator", "1.5.14a", t.result[0], t.dev_power, t.dev_clock, t.dev_mem, True, t.benchmark_length)
+            db.save(t.algo, t.dev_uuid, "excavator", "1.5.14a", t.result[0], t.dev_power, t.dev_clock, t.dev_mem, not t.crashed, t.length, t.confidence)
+
+    # One excavator instance for the whole suite
+    excavator = excavator_benchmark.ExcavatorInstance(args.excavator_path)
+    suite_start = time.time()
+
+    # Gpu crashes end the running benchmark and prune the settings beyond it
+    watch = CrashWatch(devices)
+    watch.start()
+
+    if args.search:
+        dimensions = {
+            "gpu_clock": oc_search.parse_dimension(args.clock_range) if args.clock_range else None,
+            "mem_clock": oc_search.parse_dimension(args.mem_range) if args.mem_range else None,
+            "power": oc_search.parse_dimension(args.power_range) if args.power_range else None
+        }
+        grid = len(clock_range) * len(power_range) * len(mem_range)
+        logger.info("Searching %d algorithms adaptively, full grid would be %d bechmarks per algorithm", len(algos), grid)
+
+        record_lock = threading.Lock()
+        def record_locked(t):
+            with record_lock:
+                record(t)
+
+        def search_device(device):
+            for a in algos:
+                run_search(device, a, args.length, dimensions, db, record_locked, args.tolerance, excavator, watch)
+
+        # Searches are sequential per device, run one per device in parallel
+        threads = [threading.Thread(target=search_device, args=(d,), name="gpu%d" % (d)) for d in devices]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    else:
+        scheduler = Scheduler(devices, excavator, record,
+            on_start=checkpoint.start if checkpoint else None,
+            watch=watch,
+            on_pruned=checkpoint.pruned if checkpoint else None)
+
+        if args.distribute:
+            tasks = generate_tasks_oc_range(None, algos, args.length, clock_range, power_range, mem_range, args.tolerance)
+        else:
+            tasks = []
+            for d in devices:
+                if args.overclock_file:
+                    tasks += generate_tasks_oc_file(d, algos, args.length, args.overclock_file, args.tolerance)
+                else:
+                    tasks += generate_tasks_oc_range(d, algos, args.length, clock_range, power_range, mem_range, args.tolerance)
+
+        uuids = dict((d, nvidia_smi.device(d)["uuid"]) for d in devices)
+        pending = []
+        for t in tasks:
+            if args.resume:
+                entry = checkpoint.finished(t) if checkpoint else None
+                if entry and entry["status"] == "pruned":
+                    continue
+                if entry:
+                    interrupted = entry["status"] == "running"
+                    checkpoint.restore(t, entry)
+                    if interrupted:
+                        logger.warning("Recording interrupted bechmark as crashed: %s", str(t))
+                    record(t, save=interrupted)
+                    continue
+                if db and restore_from_db(db, {t.device: uuids[t.device]} if t.device is not None else uuids, t):
+                    record(t, save=False)
+                    continue
+            if checkpoint:
+                checkpoint.add(t)
+            scheduler.add(t)
+            pending.append(t)
+
+        if checkpoint:
+            checkpoint.save()
+        if len(pending) < len(tasks):
+            logger.info("Resuming, skipped %d finished bechmarks", len(tasks) - len(pending))
+        tasks = pending
+
+        logger.info("Running %d bechmarks on %d devices, with estimated total execution time: %.1f min", len(tasks), len(devices), float(len(tasks) * (args.length+4))/ 60.0 / len(devices))
+
+        scheduler.run()
+        if scheduler.pruned:
+            logger.info("Pruned %d bechmarks beyond crashed settings", scheduler.pruned)
+
+    watch.stop()
+    excavator.stop()
+    logger.info("Suite finished in %.1f min, %.1f min setup overhead, excavator started %d times", (time.time() - suite_start) / 60.0, setup_total / 60.0, excavator.starts)
 
     if(args.csv):
         with open(args.csv, "w") as f:
@@ -177,4 +579,3 @@ if(__name__ == "__main__"):
             out = json.dumps(top, indent=4, sort_keys=True, separators=(',', ': '))
             logger.debug("Generated json: \n%s", out)
             f.write(out)
-
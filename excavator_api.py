@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import asyncio
 import json
 import logging
 import signal
@@ -9,6 +10,7 @@ import sys
 import re
 import json
 import subprocess
+import threading
 import time
 from pprint import pprint
 from time import sleep
@@ -25,12 +27,51 @@ class ExcavatorApiError(ExcavatorError):
         self.response = response
         self.error = response['error']
 
+def get_stratum(region):
+    return 'nhmp.%s.nicehash.com:%s' % (region, 3200)
+
+def state_set_params(device_uuid, algorithm, region, wallet, name):
+    params = {}
+    params["btc_address"] = wallet + "." + name + ":x"
+    #params["btc_address"] = "34HKWdzLxWBduUfJE9JxaFhoXnfC6gmePG.test2:x"
+    params["stratum_url"] = get_stratum(region)
+    params["devices"] = [
+        {
+            "device_uuid": device_uuid,
+            "algorithm": algorithm,
+            "params": []
+        }
+    ]
+    return params
+
+def speeds_by_device(worker_list):
+    """Maps a worker.list response to device id -> {algorithm: speed}."""
+    out = {}
+    for w in worker_list["workers"]:
+        speeds = out.setdefault(w["device_id"], {})
+        for a in w["algorithms"]:
+            speeds[a["name"]] = a["speed"]
+    return out
+
 class ExcavatorApi:
 
-    def __init__(self, address=("127.0.0.1", 3456)):
+    BUF_SIZE = 65536
+
+    def __init__(self, address=("127.0.0.1", 3456), persistent=False):
+        """Excavator api client.
+
+        address -- (host, port) of the excavator api
+        persistent -- keep one connection open between commands instead of
+                      connecting for every command
+        """
 
         self.address = address
+        self.persistent = persistent
 
+        self.socket = None
+        self.buffer = b''
+        self.next_id = 0
+        self.lock = threading.Lock()
 
     def worker_add(self, algo, device):
         response = self.do_excavator_command('worker.add', [algo, str(device)])
@@ -68,30 +109,17 @@ class ExcavatorApi:
 
     def quit(self):
         self.do_excavator_command('quit', expect_response=False)
+        self.close()
 
     def device_speeds(self, device):
-        res = self.do_excavator_command('worker.list')
-        for w in res["workers"]:
-            if(w["device_id"] == device):
-                out = {}
-                for a in w["algorithms"]:
-                    out[a["name"]] = a["speed"]
-                return out
-        return {}
+        return self.all_device_speeds().get(device, {})
+
+    def all_device_speeds(self):
+        """Returns a dict of device id -> {algorithm: speed} from a single worker.list."""
+        return speeds_by_device(self.do_excavator_command('worker.list'))
 
     def state_set(self, device_uuid, algorithm, region, wallet, name):
-        params = {}
-        params["btc_address"] = wallet + "." + name + ":x"
-        #params["btc_address"] = "34HKWdzLxWBduUfJE9JxaFhoXnfC6gmePG.test2:x"
-        params["stratum_url"] = self.get_stratum(region)
-        params["devices"] = [
-            {
-                "device_uuid": device_uuid,
-                "algorithm": algorithm,
-                "params": []
-            }
-        ]
-        self.do_excavator_command('state.set', params)
+        self.do_excavator_command('state.set', state_set_params(device_uuid, algorithm, region, wallet, name))
 
     def info(self):
         res = self.do_excavator_command('info')
@@ -106,7 +134,12 @@ class ExcavatorApi:
             return True
 
     def get_stratum(self, region):
-        return 'nhmp.%s.nicehash.com:%s' % (region, 3200)
+        return get_stratum(region)
+
+    def close(self):
+        """Closes the persistent connection, if any."""
+        with self.lock:
+            self._disconnect()
 
     def do_excavator_command(self, method, params = [], expect_response=True):
         """Sends a command to excavator, returns the JSON-encoded response.
@@ -115,37 +148,346 @@ class ExcavatorApi:
         params -- list of arguments for the command
         """
 
-        BUF_SIZE = 1024
+        responses = self.do_excavator_commands([(method, params)], expect_response)
+        if expect_response:
+            return responses[0]
+
+    def do_excavator_commands(self, commands, expect_response=True):
+        """Pipelines several commands, returns the responses in the same order.
+
+        All commands are written before any reply is read, so the batch costs a
+        single round-trip. Raises ExcavatorApiError for the first failed command
+        once every reply has been read.
+
+        commands -- list of (method, params) tuples
+        """
+
+        with self.lock:
+            reused = self.socket is not None
+            try:
+                responses = self._send_commands(commands, expect_response)
+            except (ConnectionResetError, BrokenPipeError):
+                self._disconnect()
+                if not reused:
+                    raise
+                # Excavator may have dropped an idle connection, try once more
+                logging.debug("Excavator connection lost, reconnecting")
+                responses = self._send_commands(commands, expect_response)
+            except socket.error:
+                # Including timeouts: the commands may have run, do not resend
+                self._disconnect()
+                raise
+            except ValueError:
+                # Unparsable reply, the stream can not be trusted any more
+                self._disconnect()
+                raise
+            finally:
+                if not self.persistent:
+                    self._disconnect()
+
+        for response in responses:
+            if response.get('error') is not None:
+                raise ExcavatorApiError(response)
+        return responses
+
+    def _connect(self):
+        if self.socket is None:
+            self.socket = socket.create_connection(self.address, EXCAVATOR_TIMEOUT)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.buffer = b''
+        return self.socket
+
+    def _disconnect(self):
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except socket.error:
+                pass
+        self.socket = None
+        self.buffer = b''
+
+    def _send_commands(self, commands, expect_response):
+        s = self._connect()
+
+        ids = []
+        out = []
+        for method, params in commands:
+            self.next_id += 1
+            ids.append(self.next_id)
+            command = {
+                'id': self.next_id,
+                'method': method,
+                'params': params
+                }
+            out.append(json.dumps(command).replace('\n', '\\n') + '\n')
+        s.sendall(''.join(out).encode())
+
+        if not expect_response:
+            return []
+
+        pending = set(ids)
+        responses = {}
+        while pending:
+            response_data = json.loads(self._read_line(s))
+            if response_data.get('id') in pending:
+                pending.remove(response_data['id'])
+                responses[response_data['id']] = response_data
+
+        return [responses[i] for i in ids]
+
+    def _read_line(self, s):
+        while True:
+            end = self.buffer.find(b'\n')
+            if end != -1:
+                line = self.buffer[:end]
+                self.buffer = self.buffer[end + 1:]
+                return line.decode()
+
+            chunk = s.recv(self.BUF_SIZE)
+            if not chunk:
+                raise ConnectionResetError("Excavator closed the connection")
+            self.buffer += chunk
+
+
+class AsyncExcavatorApi:
+    """asyncio excavator api client.
+
+    All commands share one connection and replies are matched to requests by
+    id, so any number of commands can be in flight at once. Every call takes an
+    optional timeout (seconds, default EXCAVATOR_TIMEOUT) that only applies to
+    that call; a late reply to a timed out command is discarded.
+    """
+
+    LINE_LIMIT = 2 ** 20
+
+    def __init__(self, address=("127.0.0.1", 3456), timeout=EXCAVATOR_TIMEOUT):
+        self.address = address
+        self.timeout = timeout
+
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.connect_lock = None
+        self.pending = {}
+        self.next_id = 0
+
+    async def device_speed_reset(self, device_uuid, timeout=None):
+        await self.do_excavator_command('worker.reset.device', [str(device_uuid)], timeout=timeout)
+
+    async def message(self, msg, timeout=None):
+        await self.do_excavator_command('message', [msg], timeout=timeout)
+
+    async def stop(self, timeout=None):
+        await self.do_excavator_command('miner.stop', timeout=timeout)
+
+    async def device_speeds(self, device, timeout=None):
+        speeds = await self.all_device_speeds(timeout=timeout)
+        return speeds.get(device, {})
+
+    async def all_device_speeds(self, timeout=None):
+        res = await self.do_excavator_command('worker.list', timeout=timeout)
+        return speeds_by_device(res)
+
+    async def state_set(self, device_uuid, algorithm, region, wallet, name, timeout=None):
+        params = state_set_params(device_uuid, algorithm, region, wallet, name)
+        await self.do_excavator_command('state.set', params, timeout=timeout)
+
+    async def info(self, timeout=None):
+        return await self.do_excavator_command('info', timeout=timeout)
+
+    async def is_alive(self, timeout=None):
+        try:
+            await self.message("miner.alive", timeout=timeout)
+        except (asyncio.TimeoutError, socket.error):
+            return False
+        else:
+            return True
+
+    async def gather(self, *calls):
+        """Runs commands concurrently, returns results or exceptions in order.
+
+        A failing or timed out call does not affect the others.
+        """
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:
+                await self.reader_task
+            except asyncio.CancelledError:
+                pass
+        self._connection_lost(ConnectionResetError("Connection closed"))
+
+    async def do_excavator_command(self, method, params = [], timeout=None):
+        """Sends a command to excavator, returns the JSON-encoded response.
+
+        method -- name of the command to execute
+        params -- list of arguments for the command
+        timeout -- deadline for this call in seconds
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+        return await asyncio.wait_for(self._command(method, params), timeout)
+
+    async def _command(self, method, params):
+        await self._connect()
+
+        self.next_id += 1
+        seq = self.next_id
         command = {
-            'id': 1,
+            'id': seq,
             'method': method,
             'params': params
             }
-        s = socket.create_connection(self.address, EXCAVATOR_TIMEOUT)
-        
-        s.sendall((json.dumps(command).replace('\n', '\\n') + '\n').encode())
-        
-        if expect_response:
 
-            response = ''
+        # Register before writing so a fast reply always finds its waiter
+        future = asyncio.get_running_loop().create_future()
+        self.pending[seq] = future
+        try:
+            self.writer.write((json.dumps(command) + '\n').encode())
+            await self.writer.drain()
+            return await future
+        finally:
+            self.pending.pop(seq, None)
+
+    async def _connect(self):
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(*self.address, limit=self.LINE_LIMIT)
+                self.reader_task = asyncio.ensure_future(self._read_responses(self.reader))
+
+    async def _read_responses(self, reader):
+        try:
             while True:
-                chunk = s.recv(BUF_SIZE).decode()
-                
-                if '\n' in chunk:
-                    response += chunk[:chunk.index('\n')]
-                    break
+                line = await reader.readline()
+                if not line:
+                    raise ConnectionResetError("Excavator closed the connection")
+                response_data = json.loads(line.decode())
+                future = self.pending.get(response_data.get('id'))
+                if future is None or future.done():
+                    continue
+                if response_data.get('error') is None:
+                    future.set_result(response_data)
                 else:
-                    response += chunk
-            s.close()
+                    future.set_exception(ExcavatorApiError(response_data))
+        except (socket.error, ValueError) as e:
+            if reader is self.reader:
+                self._connection_lost(e)
+
+    def _connection_lost(self, error):
+        logging.debug("Excavator connection lost: %s", error)
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError(str(error)))
+        self.pending.clear()
+
+
+class ExcavatorThread(threading.Thread):
+    """Runs an AsyncExcavatorApi on an asyncio loop in its own thread.
+
+    Other threads submit() coroutines of self.api and get the result in a
+    callback, so a stalled excavator reply never blocks them, and commands
+    for different devices run concurrently with their own deadlines.
+    """
+
+    def __init__(self, address=("127.0.0.1", 3456), timeout=EXCAVATOR_TIMEOUT):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.loop = asyncio.new_event_loop()
+        self.api = AsyncExcavatorApi(address, timeout)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
 
-            response_data = json.loads(response)
-            if "error" not in response_data or response_data['error'] is None:
-                return response_data
-            else:
-                raise ExcavatorApiError(response_data)
+    def stop(self):
+        self.call(self.api.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def submit(self, coro, on_done=None):
+        """Schedules coro on the loop, returns a concurrent.futures.Future.
+
+        on_done -- optional callable(result, error), called from the loop thread
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if on_done:
+            def done(f):
+                error = asyncio.CancelledError() if f.cancelled() else f.exception()
+                on_done(None if error else f.result(), error)
+            future.add_done_callback(done)
+        return future
+
+    def call(self, coro, timeout=None):
+        """Runs coro on the loop and waits for its result."""
+        return self.submit(coro).result(timeout)
+
+    def device_speed_reset(self, device_uuid):
+        """Like ExcavatorApi.device_speed_reset(), without waiting for the reply."""
+        def done(result, error):
+            if error:
+                logging.warning("Could not reset speed of %s: %s", device_uuid, str(error))
+        self.submit(self.api.device_speed_reset(device_uuid), done)
+
+
+def benchmark(count=2000, batch=10):
+    """Measures commands/second against a local fake excavator."""
+    import socketserver
+
+    class FakeExcavatorHandler(socketserver.StreamRequestHandler):
+        disable_nagle_algorithm = True
+
+        def handle(self):
+            for line in self.rfile:
+                command = json.loads(line.decode())
+                if command['method'] == 'quit':
+                    return
+                self.wfile.write((json.dumps({'id': command['id'], 'error': None}) + '\n').encode())
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), FakeExcavatorHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def run(name, excavator, fn):
+        start = time.time()
+        fn(excavator)
+        elapsed = time.time() - start
+        print("%-12s %8.0f commands/s" % (name, count / elapsed))
+        excavator.close()
+
+    def single(excavator):
+        for i in range(count):
+            excavator.message("miner.alive")
+
+    def pipelined(excavator):
+        for i in range(count // batch):
+            excavator.do_excavator_commands([('message', ["miner.alive"])] * batch)
+
+    run("connect", ExcavatorApi(server.server_address), single)
+    run("persistent", ExcavatorApi(server.server_address, persistent=True), single)
+    run("pipelined", ExcavatorApi(server.server_address, persistent=True), pipelined)
+
+    server.shutdown()
+    server.server_close()
 
 
 if __name__ == '__main__':
+
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
+        sys.exit(0)
+
     excavator = ExcavatorApi()
 
     excavator.subscribe("eu", "3FkaDHat56SfuJaueRo9CCUM1rCGMK2coQ", "testrig")
@@ -7,17 +7,28 @@ import re
 import json
 import tempfile
 import subprocess
+import threading
 import overclock_session
 import overclock
 import excavator_api
 import nvidia_smi
 
 class Benchmark():
-    def __init__(self, device, algo, benchmark_length, oc_spec=None):
+    def __init__(self, device, algo, benchmark_length, oc_spec=None, tolerance=None):
+        """benchmark_length -- maximum length [s]
+        tolerance -- end early when the hashrate confidence interval is within this ratio of the mean
+        """
         self.device = device
         self.algo = algo
         self.benchmark_length = benchmark_length
+        self.tolerance = tolerance
         self.result = []
+        self.length = None
+        self.confidence = None
+        self.setup_time = None
+        self.crashed = False
+        # Set from another thread when the gpu reports a crash (xid event)
+        self.xid = None
 
         self.oc_spec = oc_spec
         if not self.oc_spec:
@@ -36,42 +47,138 @@ class Benchmark():
         return ",".join([str(self.dev_power), str(self.dev_clock), str(self.dev_temp), str(self.result[0]), str(self.dev_mem)])
 
 
-def run_benchmark(task: Benchmark, oc_warmup_1=2, oc_warmup_2=20):
+class ExcavatorInstance():
+    """A temperature guarded excavator process shared by consecutive benchmarks.
+
+    Benchmarks switch algorithm with state_set on the running instance, it is
+    only (re)started when it is not running, e.g. after a crash. Benchmarks on
+    different devices may share the instance from several threads.
+    """
+
+    START_TIMEOUT = 60
+
+    def __init__(self, excavator_path="excavator", max_temperature=80):
+        self.command = ['./temperature_guard.py', str(max_temperature), excavator_path]
+        self.api = excavator_api.ExcavatorApi(persistent=True)
+        self.proc = None
+        self.starts = 0
+        self.lock = threading.RLock()
+
+    def running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.proc = subprocess.Popen(self.command)
+        self.starts += 1
+
+        logging.info('connecting to excavator')
+        start = time.time()
+        while not self.api.is_alive():
+            if not self.running() or time.time() - start > self.START_TIMEOUT:
+                self.kill()
+                raise excavator_api.ExcavatorError("Excavator did not start")
+            time.sleep(0.5)
+
+    def ensure(self):
+        """Starts excavator unless it is running and responding, returns True if it was (re)started."""
+        with self.lock:
+            if self.running() and self.api.is_alive():
+                return False
+            if self.proc is not None:
+                logging.warning('excavator not running, restarting')
+                self.kill()
+            self.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            if self.running():
+                try:
+                    self.api.stop()
+                    self.api.quit()
+                except (excavator_api.ExcavatorError, OSError):
+                    pass
+            self.kill()
+
+    def kill(self, generation=None):
+        """Kills excavator. With generation (the starts count when a benchmark
+        began), an instance restarted since then is left running."""
+        with self.lock:
+            if generation is not None and generation != self.starts:
+                return
+            self.api.close()
+            if self.proc is not None:
+                self.proc.terminate()
+                self.proc.wait()
+                self.proc = None
+
+
+def run_benchmark(task: Benchmark, oc_warmup_1=2, oc_warmup_2=20, excavator: ExcavatorInstance=None):
+    """Runs task, on excavator if given, otherwise on a new excavator process.
+
+    Sets task.setup_time to the time spent before measuring (excavator
+    start, algorithm switch and warmup). If excavator stops responding the
+    task is marked as crashed with a 0 result.
+    """
+
+    start = time.time()
 
     device_oc = overclock.Device(task.device)
-    device_oc.refresh()
 
-    # Start excavator
-    excavator = excavator_api.ExcavatorApi()
-    excavator_proc = subprocess.Popen(['./temperature_guard.py', '80', 'excavator'])
-
-    logging.info('connecting to excavator')
-    while not excavator.is_alive():
-        time.sleep(0.5)
-
-    uuid = nvidia_smi.device(task.device)["uuid"]
-    excavator.state_set(uuid, "benchmark-"+task.algo, "eu", "3FkaDHat56SfuJaueRo9CCUM1rCGMK2coQ", "wr03")
-
-    strategy = overclock_session.OcStrategyStatic(uuid, task.algo, task.oc_spec)
-    oc_session = overclock_session.OcSession(strategy, device_oc, None, excavator)
-
-    while(oc_session.get_result()["length"] < task.benchmark_length):
-        speeds = excavator.device_speeds(task.device)
-        current_speed = speeds[task.algo] if task.algo in speeds else 0.0
-        oc_session.loop(current_speed)
-        time.sleep(1.0)
-
-    oc_session.end()
-    result = oc_session.get_result()
+    # Start excavator, or reuse the running one
+    owned = excavator is None
+    if owned:
+        excavator = ExcavatorInstance()
+    with excavator.lock:
+        excavator.ensure()
+        generation = excavator.starts
+    api = excavator.api
+
+    oc_session = None
+    try:
+        # Another device's crash may kill excavator at any point after ensure()
+        device_oc.refresh()
+        uuid = nvidia_smi.device(task.device)["uuid"]
+        api.state_set(uuid, "benchmark-"+task.algo, "eu", "3FkaDHat56SfuJaueRo9CCUM1rCGMK2coQ", "wr03")
+
+        strategy = overclock_session.OcStrategyStatic(uuid, task.algo, task.oc_spec)
+        oc_session = overclock_session.OcSession(strategy, device_oc, None, api, task.tolerance)
+
+        while(oc_session.get_result()["length"] < task.benchmark_length):
+            if task.xid is not None:
+                logging.error('Gpu %d crashed during benchmark (xid: %d)', task.device, task.xid)
+                task.crashed = True
+                excavator.kill(generation)
+                break
+            speeds = api.device_speeds(task.device)
+            current_speed = speeds[task.algo] if task.algo in speeds else 0.0
+            oc_session.loop(current_speed)
+            if task.setup_time is None and oc_session.state == overclock_session.OcSession.State.ACTIVE:
+                task.setup_time = time.time() - start
+            if oc_session.converged():
+                logging.info('Hashrate converged after %.0f s', oc_session.get_result()["length"])
+                break
+            time.sleep(1.0)
+    except (excavator_api.ExcavatorError, OSError) as e:
+        logging.error('Excavator failed during benchmark: %s', str(e))
+        task.crashed = True
+        excavator.kill(generation)
+
+    result = {"length": 0, "avg_full": 0, "confidence": None}
+    if oc_session is not None:
+        oc_session.end()
+        result = oc_session.get_result()
     logging.debug('Benchmark results: %s', str(result))
 
-    excavator.stop()
-    excavator.quit()
+    task.length = result["length"]
+    task.confidence = result["confidence"]
 
-    excavator_proc.terminate()
-    excavator_proc.wait()
+    if owned:
+        excavator.stop()
 
     # TODO Handle dual algos
+    if task.crashed:
+        return [0.0]
     return [result["avg_full"]]
 
 
@@ -84,6 +191,7 @@ if(__name__ == "__main__"):
     parser.add_argument("--algo", '-a', help='algorithm', required = True)
     parser.add_argument("--device", "-d", help='device number (default: 0)', default = 0, type=int)
     parser.add_argument("--length", '-l', help='length [s] (default: 100)', default = 100, type=int)
+    parser.add_argument("--tolerance", '-t', help='end when the 95%% confidence interval is within this ratio of the mean, example: 0.005', default = None, type=float)
 
     parser.add_argument("--oc-gpu", help='gpu clock offset', default = None, type=int)
     parser.add_argument("--oc-mem", help='memory clock offset', default = None, type=int)
@@ -105,9 +213,13 @@ if(__name__ == "__main__"):
 
 
     oc_spec = overclock_session.OcSpec(args.oc_gpu, args.oc_mem, args.oc_power)
-    task = Benchmark(args.device, args.algo, args.length, oc_spec)
+    task = Benchmark(args.device, args.algo, args.length, oc_spec, args.tolerance)
 
 
     logger.info("Running %s benchmark for %d seconds", args.algo, args.length)
-    rates = run_benchmark(task)
-    logger.info("Benchmark finished, %s rate: [%s] H/s", args.algo, ", ".join(str(x) for x in rates))
+    excavator = ExcavatorInstance(args.excavator_path)
+    try:
+        rates = run_benchmark(task, args.oc_warmup_1, args.oc_warmup_2, excavator)
+    finally:
+        excavator.stop()
+    logger.info("Benchmark finished, %s rate: [%s] H/s, confidence: %s, length: %.0f s", args.algo, ", ".join(str(x) for x in rates), str(task.confidence), task.length)
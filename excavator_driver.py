@@ -12,6 +12,7 @@ import re
 import json
 import subprocess
 import time
+import queue
 import prctl
 from pprint import pprint
 from time import sleep
@@ -22,12 +23,17 @@ import homie
 import nvidia_smi
 import excavator_api
 import nicehash_api
+import profitability
 import overclock
+import overclock_session
+import oc_search
 import ws_ipc
 import benchmark_db
 
 UPDATE_INTERVAL = 30
 SPEED_INTERVAL = 2
+# Deadline of a state.set, per device
+STATE_SET_TIMEOUT = 5
 
 # TODO read from config file
 # TODO sync to nh update time
@@ -47,7 +53,7 @@ SPEED_INTERVAL = 2
 
 class Driver:
 
-    def __init__(self, wallet, region, benchmarks, devices, name, oc_strat, oc_file, switching_threshold, run_excavator, ipc_port, autostart, db, mqtt_host, mqtt_name):
+    def __init__(self, wallet, region, benchmarks, devices, name, oc_strat, oc_file, switching_threshold, run_excavator, ipc_port, autostart, db, mqtt_host, mqtt_name, oc_verify_interval=None, oc_metric=overclock_session.BestSpecIndex.HASHRATE, oc_search_dimensions=None):
 
         self.wallet = wallet
         self.region = region
@@ -61,7 +67,9 @@ class Driver:
         self.db = db
 
         self.state = Driver.State.INIT
-        self.device_monitor = nvidia_smi.Monitor(data=["xidEvent", "temp"])
+        # All inputs of the main loop, as (Driver.Event, payload) tuples
+        self.events = queue.Queue()
+        self.device_monitor = nvidia_smi.Monitor(data=["xidEvent", "temp"], sink=lambda e: self.events.put((Driver.Event.DEVICE, e)))
         self.excavator_proc = None
         self.ipc = None
 
@@ -94,7 +102,12 @@ class Driver:
         # dict of device id -> settings
         self.device_settings = {}
 
-        self.paying_current = None
+        # Rates persisted by an earlier run let us pick algorithms before the first fetch
+        self.paying_cache = nicehash_api.PayingCache()
+        self.paying_current = self.paying_cache.paying if self.paying_cache.usable() else None
+        self.payrate_matrix = profitability.PayrateMatrix(benchmarks)
+        # devices x algorithms mBTC/day from the last switching decision
+        self.payrates_current = None
 
         for d in self.devices:
             dev = Driver.DeviceSettings()
@@ -103,13 +116,36 @@ class Driver:
             dev.oc_strategy = oc_strat
             self.device_settings[d] = dev
 
-        self.excavator = excavator_api.ExcavatorApi()
+        # Excavator commands run on their own loop thread, replies come back as events
+        self.excavator = excavator_api.ExcavatorThread()
+        self.speeds_pending = False
 
         self.oc_config = None
 
+        # Device discovery: one nvidia-smi -L, per gpu xml queried in parallel
+        discovery_start = time.time()
         for d in devices:
             self.devices_oc[d] = overclock.Device(d)
-            self.devices_oc[d].refresh()
+        overclock.refresh_all(self.devices_oc.values())
+
+        for device, ds in self.device_settings.items():
+            ds.uuid = nvidia_smi.device(device)["uuid"]
+        logging.info("Device discovery took %.2f s (%d devices)", time.time() - discovery_start, len(devices))
+
+        # Best known overclock per (uuid, algo), loaded once for the db_best strategy
+        self.oc_index = None
+        if oc_strat == Driver.DeviceSettings.OcStrategy.DB_BEST:
+            power_limits = dict((ds.uuid, self.devices_oc[d].snapshot.default_power_limit) for d, ds in self.device_settings.items() if self.devices_oc[d].snapshot.default_power_limit)
+            self.oc_index = overclock_session.BestSpecIndex(self.db, oc_metric, power_limits)
+
+        # dict of (uuid, algo) -> oc_search.CoordinateSearch for the db_search strategy
+        self.oc_search_dimensions = oc_search_dimensions
+        self.oc_searches = {}
+
+        # Overclock read-backs come from the devices' records, checked against the hardware in the background
+        self.oc_reconciler = None
+        if oc_verify_interval:
+            self.oc_reconciler = overclock.Reconciler(self.devices_oc.values(), oc_verify_interval)
 
     class DeviceSettings:
 
@@ -133,241 +169,21 @@ class Driver:
             self.oc_strategy = self.OcStrategy.NONE
             self.oc_session = None
 
-    class OcSpec:
-        def __init__(self):
-            self.gpu_clock = None
-            self.mem_clock = None
-            self.power = None
-
-        def equals(self, other):
-            return self.gpu_clock == other.gpu_clock and self.mem_clock == other.mem_clock and self.power == other.power
-        
-        def keys(self):
-            return ["gpu_clock", "mem_clock", "power"]
-
-        def __str__(self):
-
-            spec = [("%s: %i" % (k, self.__getattribute__(k))) for k in self.keys() if self.__getattribute__(k) != None]
-            return "None" if len(spec) == 0 else ", ".join(spec)
-
-    class OcStrategy:
-        def __init__(self, device_uuid, algo):
-            self.device_uuid = device_uuid
-            self.algo = algo
-            
-        def get_spec(self):
-            pass
-        
-        def refresh(self):
-            pass
-    
-    class OcStrategyFile(OcStrategy):
-        def __init__(self, device_uuid, algo, filename):
-            Driver.OcStrategy.__init__(self, device_uuid, algo)
-            self.filename = filename
-            self.oc_config = None
-
-            self.refresh()
-        
-        def refresh(self):
-            self.oc_config = json.load(open(self.filename))
-        
-        def get_spec(self):
-            spec = Driver.OcSpec()
-
-            paths = [
-                [self.device_uuid, self.algo], 
-                [self.device_uuid, "default"], 
-                ["default", self.algo], 
-                ["default", "default"]
-            ]
-
-            for e in spec.keys():
-                for p in paths:
-                    if p[0] in self.oc_config and p[1] in self.oc_config[p[0]] and e in self.oc_config[p[0]][p[1]]:
-                        spec.__setattr__(e, self.oc_config[p[0]][p[1]][e])
-                        break
-
-            return spec
-
-    class OcSession:
-        class State:
-            INACTIVE = "inactive"
-            WARMUP_1 = "warmup_1"
-            WARMUP_2 = "warmup_2"
-            ACTIVE = "active"
-            FINISHING = "finishing"
-
-        
+    class OcSession(overclock_session.OcSession):
         TIME_WARMUP_1 = 10
-        TIME_WARMUP_2 = 20
-        BENCHMARK_MIN_LENGTH = 100
-
-        def __init__(self, strategy, dev, database, excavator):
-            
-            self.strategy = strategy
-            self.dev = dev
-            self.applied_oc = Driver.OcSpec()
-            self.database = database
-            self.excavator = excavator
-
-            self.avg_full = 0
-            self.benchmark_result = {
-                "length": 0,
-                "avg_full": 0,
-                "current_speed": 0
-            }
-
-            self._set_state(self.State.INACTIVE)
-            self.reset_timer()
-        
-        def end(self):
-            self.set_finishing()
-
-        def reset_timer(self):
-            self.state_time_start = time.time()
-            self.state_time_last = self.state_time_start
-
-        def _set_state(self, state):
-            self.state = state
-            logging.info("[%s] Oc session state: %s", self.strategy.device_uuid, state)
-
-        def set_warmup_1(self):
-            self._set_state(self.State.WARMUP_1)
-            self.reset_timer()
-
-        def set_warmup_2(self):
-            self._set_state(self.State.WARMUP_2)
-            self.reset_timer()
-            self.overclock()
-        
-        def set_active(self):
-            self._set_state(self.State.ACTIVE)
-            self.excavator.device_speed_reset(self.strategy.device_uuid)
-            self.reset_timer()
-            # Reset speed measurement?
-
-        def set_finishing(self):
-
-            # Write to db if state is ACTIVE
-            dev_power = 0
-            dev_clock = 0
-            dev_power = 0
-            
-            try:
-                dev_clock = self.dev.get_clock_offset()
-            except overclock.NotSupportedException:
-                dev_clock = 0
-            
-            try:
-                dev_mem = self.dev.get_memory_offset()
-            except overclock.NotSupportedException:
-                dev_mem = 0
-
-            try:
-                dev_power = self.dev.get_power_offset()
-            except overclock.NotSupportedException:
-                dev_power = 0
-
-            if self.database and \
-                    self.state == self.State.ACTIVE and \
-                    self.benchmark_result["length"] > self.BENCHMARK_MIN_LENGTH:
-                logging.debug("Saving benchmark result: %s", str(self.benchmark_result))
-                self.database.save(self.strategy.algo, 
-                    self.strategy.device_uuid, 
-                    "excavator", "1.5.14a", 
-                    self.benchmark_result["avg_full"], 
-                    dev_power, 
-                    dev_clock, 
-                    dev_mem, 
-                    True, 
-                    self.benchmark_result["length"])
-
-            self._set_state(self.State.FINISHING)
-            self.reset_timer()
-            self.reset_overclock()
-
-        def get_speeds(self):
-            # TODO ERROR!
-            return self.benchmark_result["length"] > 10
-
-        def loop_active(self, current_speed):
-            now = time.time()
-            time_prev = self.state_time_last - self.state_time_start
-            time_cuml = now - self.state_time_start
-            time_step = now - self.state_time_last
-            self.state_time_last = now
-
-            self.avg_full = (self.avg_full * time_prev + current_speed * time_step) / time_cuml
-
-            self.benchmark_result = {
-                "length": time_cuml,
-                "avg_full": self.avg_full,
-                "current_speed": current_speed
-            }
-
-        def loop(self, current_speed):
-
-            if self.state == self.State.INACTIVE:
-                if time.time() - self.state_time_start > 0:
-                    self.set_warmup_1()
-            if self.state == self.State.WARMUP_1:
-                if time.time() - self.state_time_start > self.TIME_WARMUP_1:
-                    self.set_warmup_2()
-            if self.state == self.State.WARMUP_2:
-                if time.time() - self.state_time_start > self.TIME_WARMUP_2:
-                    self.set_active()
-            if self.state == self.State.ACTIVE:
-                self.loop_active(current_speed)
-
-        def overclock(self):
-            self.strategy.refresh()
-            spec = self.strategy.get_spec()
-
-            logging.info("[%s] Applying Oc: %s", self.strategy.device_uuid, spec)
-
-            if not self.applied_oc.equals(spec):
-
-                if spec.gpu_clock:
-                    self.dev.set_clock_offset(spec.gpu_clock)
-                    logging.info("overclocking device %i, gpu_clock: %s" % (self.dev.device_number, str(spec.gpu_clock)))
-                if spec.mem_clock:
-                    self.dev.set_memory_offset(spec.mem_clock)
-                    logging.info("overclocking device %i, mem_clock: %s" % (self.dev.device_number, str(spec.mem_clock)))
-                if spec.power:
-                    try:
-                        self.dev.set_power_offset(spec.power)
-                        logging.info("overclocking device %i, power: %s" % (self.dev.device_number, str(spec.power)))
-                    except:
-                        pass
-                self.applied_oc = spec
-
-        def reset_overclock(self):
-            logging.info("[%s] Resetting Oc", self.strategy.device_uuid)
-
-            # Reset overclocking
-            if self.applied_oc.gpu_clock:
-                self.dev.set_clock_offset(0)
-                logging.info("overclocking device %i, gpu_clock: %s" % (self.dev.device_number, str(0)))
-            if self.applied_oc.mem_clock:
-                self.dev.set_memory_offset(0)
-                logging.info("overclocking device %i, mem_clock: %s" % (self.dev.device_number, str(0)))
-            if self.applied_oc.power:
-                try:
-                    self.dev.set_power_offset(0)
-                    logging.info("overclocking device %i, power: %s" % (self.dev.device_number, str(0)))
-                except:
-                    pass
-            self.dev.unset_performance_mode()
-
-            self.applied_oc = Driver.OcSpec()
-
+        MINER_VERSION = "1.5.14a"
 
     class State:
         INIT = 0
         RUNNING = 1
         CRASHING = 2
         RESTARTING = 3
+        STOPPED = 4
+
+    class Event:
+        DEVICE = "device"
+        IPC = "ipc"
+        EXCAVATOR = "excavator"
 
     def nicehash_mbtc_algo_per_day(self, algo, speed):
         if not algo:
@@ -381,26 +197,35 @@ class Driver:
         paying -- algorithm pay information from NiceHash
         """
 
-        bms = self.benchmarks[device]
-        pay = lambda algo, speed: paying[algo.lower()]*speed*(24*60*60)*1e-11
-        def pay_benched(algo):
-            if '_' in algo:
-                return sum([pay(multi_algo, bms[algo][i]) for
-                            i, multi_algo in enumerate(algo.split('_'))])
-            else:
-                return pay(algo, bms[algo])
+        return self.payrate_matrix.device_payrates(device, paying)
 
-        return dict([(algo, pay_benched(algo)) for algo in bms.keys()])
+    def select_algorithms(self):
+        matrix = self.payrate_matrix
+        current_algos = [self.device_settings[device].current_algo for device in matrix.devices]
+        self.payrates_current, best_algos, switch = matrix.select(self.paying_current, current_algos, self.switching_threshold)
 
+        for i, device in enumerate(matrix.devices):
+            if switch[i]:
+                self.device_settings[device].best_algo = best_algos[i]
 
     def dispatch_device(self, device, algo):
         ds = self.device_settings[device]
         ds.current_algo = algo
 
-        self.excavator.state_set(ds.uuid, algo, self.region, self.wallet, self.name)
+        self.state_set(device, algo)
 
+        strategy = None
         if ds.oc_strategy == Driver.DeviceSettings.OcStrategy.FILE:
-            strategy = self.OcStrategyFile(ds.uuid, algo, self.oc_file)
+            strategy = overclock_session.OcStrategyFile(ds.uuid, algo, self.oc_file)
+        elif ds.oc_strategy == Driver.DeviceSettings.OcStrategy.DB_BEST:
+            strategy = overclock_session.OcStrategyDbBest(ds.uuid, algo, self.oc_index)
+        elif ds.oc_strategy == Driver.DeviceSettings.OcStrategy.DB_SEARCH:
+            key = (ds.uuid, algo)
+            if key not in self.oc_searches:
+                self.oc_searches[key] = oc_search.CoordinateSearch(self.oc_search_dimensions, lookup=oc_search.db_lookup(self.db, ds.uuid, algo))
+            strategy = oc_search.OcStrategyDbSearch(ds.uuid, algo, self.oc_searches[key])
+
+        if strategy:
             ds.oc_session = Driver.OcSession(strategy, self.devices_oc[device], self.db, self.excavator)
 
         ds.running = True
@@ -415,14 +240,23 @@ class Driver:
             logging.debug('Benchmark results: %s', str(result))
             ds.oc_session = None
 
-        self.excavator.state_set(ds.uuid, "", self.region, self.wallet, self.name)
+        self.state_set(device, "")
 
         ds.running = False
 
 
+    def state_set(self, device, algo):
+        """Sends state.set for device without waiting, failures come back as events."""
+        ds = self.device_settings[device]
+        self.excavator.submit(self.excavator.api.state_set(ds.uuid, algo, self.region, self.wallet, self.name, timeout=STATE_SET_TIMEOUT),
+            self.excavator_event("state_set", device))
+
+    def excavator_event(self, event_type, device=None):
+        """Returns an ExcavatorThread callback posting the reply as an event."""
+        return lambda result, error: self.events.put((Driver.Event.EXCAVATOR, {"type": event_type, "id": device, "value": result, "error": error}))
+
     def cleanup(self):
         logging.info('Cleaning up')
-        self.excavator.is_alive()
 
         self.ipc.stop()
 
@@ -438,14 +272,19 @@ class Driver:
         except Exception as e:
             logging.error("Error stopping devoce monitor: " + str(e))
 
+        if self.oc_reconciler:
+            self.oc_reconciler.stop()
+
         
-        # Reset overclocking
+        # Reset overclocking, one nvidia-settings call for all devices
+        batch = overclock.SettingsBatch()
         for device, ds in self.device_settings.items():
             if ds.running and ds.oc_session:
-                ds.oc_session.end()
+                ds.oc_session.end(batch)
+        batch.commit()
 
         try:
-            self.excavator.stop()
+            self.excavator.call(self.excavator.api.stop(), excavator_api.EXCAVATOR_TIMEOUT)
         except Exception as e:
             logging.warn("Warning stopping excavator: " + str(e))
 
@@ -527,20 +366,105 @@ class Driver:
             hd.getProperty("oc-power").update(0)
             hd.getProperty("oc-state").update("inactive")
 
+    def publish_ipc_device(self, device, algo):
+        """Updates the device's ipc state entry, sent to clients by the next ipc flush."""
+        ds = self.device_settings[device]
+        self.ipc.update("device.algo.%d" % (device), {
+                "type": "device.algo",
+                "device_id": device,
+                "device_uuid": ds.uuid,
+                "algo": algo,
+                "speed": ds.current_speed,
+                "paying": ds.paying
+            })
+
     def publish_devices(self):
         for device, ds in self.device_settings.items():          
             self.publish_device(device)
 
+    def wait_events(self, timeout):
+        """Blocks until at least one event is queued or timeout expires, returns all queued events."""
+        events = []
+        try:
+            events.append(self.events.get(timeout=timeout))
+            while True:
+                events.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return events
+
+    def handle_device_event(self, event):
+        if(event["type"] == "xidEvent"):
+            if(event["value"] == 43):
+                logging.error("Gpu %i: crashed! Waiting for signal 45 (xid: %i)" % (event["id"], event["value"]))
+                ds = self.device_settings.get(event["id"])
+                if ds and ds.oc_session:
+                    ds.oc_session.record_crash()
+                self.state = Driver.State.CRASHING
+                self.cleanup()
+            elif(event["value"] == 45):
+                logging.info("Gpu %i: recovered after crash (xid: %i)" % (event["id"], event["value"]))
+                self.state = Driver.State.RESTARTING
+            else:
+                logging.error("Gpu %i: unhandled error (xid: %i)" % (event["id"], event["value"]))
+        elif event["type"] == "temp":
+            self.device_settings[event["id"]].temperature = event["value"]
+
+    def handle_excavator_event(self, event):
+        if event["type"] == "speeds":
+            self.speeds_pending = False
+            if event["error"]:
+                logging.warning("Could not read device speeds: %s", str(event["error"]))
+            elif self.state == Driver.State.RUNNING:
+                self.update_speeds(event["value"])
+        elif event["type"] == "state_set":
+            if event["error"]:
+                logging.error("Gpu %i: state.set failed: %s", event["id"], str(event["error"]))
+        elif event["type"] == "alive":
+            if not event["value"] and self.state == Driver.State.RUNNING:
+                logging.error("Excavator is not alive, exiting")
+                self.cleanup()
+                self.state = Driver.State.STOPPED
+
+    def update_speeds(self, all_speeds):
+        for device, ds in self.device_settings.items():
+            speeds = all_speeds.get(device, {})
+            ds.current_speed = speeds[ds.current_algo] if ds.current_algo in speeds else 0.0
+            
+            if ds.oc_session:
+                ds.oc_session.loop(ds.current_speed)
+
+            ds.paying = self.nicehash_mbtc_algo_per_day(ds.current_algo, ds.current_speed)
+            self.publish_ipc_device(device, ds.current_algo)
+            
+        self.publish_devices()
+
+    def handle_ipc_event(self, event):
+        try:
+            response = None
+            logging.debug("IPC event: "+str(event))
+
+            d = event.data
+            if d["cmd"] == "device.enable":
+                self.device_settings[d["device_id"]].enabled = d["enable"]
+            elif d["cmd"] == "publish.state":
+                self.ipc.send_full(event.client)
+            elif d["cmd"] == "ipc.stats":
+                response = self.ipc.stats()
+
+            event.respond(response)
+
+        except Exception as e:
+            logging.error("Error from IPC Server: "+str(e))
+            import traceback
+            print(traceback.format_exc(e))
+
     def run(self):
 
         # Start IPC to receive remote commands
-        self.ipc = ws_ipc.IpcServer(self.ipc_port)
+        self.ipc = ws_ipc.IpcServer(self.ipc_port, sink=lambda e: self.events.put((Driver.Event.IPC, e)))
         self.ipc.start()
 
-        # Get gpu info
-        for device, ds in self.device_settings.items():
-            ds.uuid = nvidia_smi.device(device)["uuid"]
-
         # Homie setup
         if self.mqtt_host:
             self.homie_setup()
@@ -550,107 +474,60 @@ class Driver:
             self.excavator_proc = subprocess.Popen(['./temperature_guard.py', '80', 'excavator'], preexec_fn=lambda: prctl.set_pdeathsig(signal.SIGKILL))
             
         logging.info('connecting to excavator')
-        while not self.excavator.is_alive():
+        self.excavator.start()
+        while not self.excavator.call(self.excavator.api.is_alive()):
             sleep(5)
 
         #self.excavator.subscribe(self.region, self.wallet, self.name)
         self.device_monitor.start()
+        if self.oc_reconciler:
+            self.oc_reconciler.start()
         last_nh_update = 0.0
         last_speed_update = 0.0
         self.state = Driver.State.RUNNING
 
+        if self.paying_current:
+            logging.info('Using cached NiceHash stats (%.0f s old)', self.paying_cache.age())
+            self.select_algorithms()
+            last_nh_update = time.time()
+
         while True:
 
+            # Sleep until the next timer is due or an event arrives
+            if self.state == Driver.State.RUNNING:
+                next_timer = min(last_speed_update + SPEED_INTERVAL, last_nh_update + UPDATE_INTERVAL)
+                timeout = max(0.0, next_timer - time.time())
+            else:
+                timeout = SPEED_INTERVAL
+
+            for source, event in self.wait_events(timeout):
+                if source == Driver.Event.DEVICE:
+                    self.handle_device_event(event)
+                elif source == Driver.Event.IPC:
+                    self.handle_ipc_event(event)
+                elif source == Driver.Event.EXCAVATOR:
+                    self.handle_excavator_event(event)
+
+            if self.state == Driver.State.STOPPED:
+                return
+
             now = time.time()
 
-            # Read device events
-            try:
-                event = self.device_monitor.get_event(block=False)
-                #event = self.device_monitor.get_event(block=True, timeout=0.1)
-                #logging.debug("Device event: "+str(event))
-
-                if(event["type"] == "xidEvent"):
-                    if(event["value"] == 43):
-                        logging.error("Gpu %i: crashed! Waiting for signal 45 (xid: %i)" % (event["id"], event["value"]))
-                        self.state = Driver.State.CRASHING
-                        self.cleanup()
-                    elif(event["value"] == 45):
-                        logging.info("Gpu %i: recovered after crash (xid: %i)" % (event["id"], event["value"]))
-                        self.state = Driver.State.RESTARTING
-                    else:
-                        logging.error("Gpu %i: unhandled error (xid: %i)" % (event["id"], event["value"]))
-                elif event["type"] == "temp":
-                    self.device_settings[event["id"]].temperature = event["value"]
-
-            except self.device_monitor.Empty:
-                pass
-
-            # Read IPC events
-            try:
-                event = self.ipc.get_event(block=False)
-                response = None
-                logging.debug("IPC event: "+str(event))
-
-                d = event.data
-                if d["cmd"] == "device.enable":
-                    self.device_settings[d["device_id"]].enabled = d["enable"]
-                elif d["cmd"] == "publish.state":
-                    for device, ds in self.device_settings.items():
-                        self.ipc.publish({
-                                "type": "device.algo",
-                                "device_id": device,
-                                "device_uuid": ds.uuid,
-                                "algo": ds.current_algo,
-                                "speed": ds.current_speed,
-                                "paying": ds.paying
-                            })
-
-                event.respond(response)
-
-            except ws_ipc.IpcServer.Empty:
-                pass
-            except Exception as e:
-                logging.error("Error from IPC Server: "+str(e))
-                import traceback
-                print(traceback.format_exc(e))
-
-            sleep(0.1)
-
-            # Update device speeds
+            # Update device speeds, applied when the reply arrives
             if self.state == Driver.State.RUNNING and now > last_speed_update + SPEED_INTERVAL:
                 last_speed_update = now
-                for device, ds in self.device_settings.items():
-                    speeds = self.excavator.device_speeds(device)
-                    ds.current_speed = speeds[ds.current_algo] if ds.current_algo in speeds else 0.0
-                    
-                    if ds.oc_session:
-                        ds.oc_session.loop(ds.current_speed)
-
-                    ds.paying = self.nicehash_mbtc_algo_per_day(ds.current_algo, ds.current_speed)
-                    self.ipc.publish({
-                            "type": "device.algo",
-                            "device_id": device,
-                            "device_uuid": ds.uuid,
-                            "algo": ds.current_algo,
-                            "speed": ds.current_speed,
-                            "paying": ds.paying
-                        })
-                    
-                self.publish_devices()
-
-
+                if not self.speeds_pending:
+                    self.speeds_pending = True
+                    self.excavator.submit(self.excavator.api.all_device_speeds(timeout=SPEED_INTERVAL), self.excavator_event("speeds"))
 
             # Algorithm switching
             if self.state == Driver.State.RUNNING and now > last_nh_update + UPDATE_INTERVAL:
                 last_nh_update = now
 
-                if not self.excavator.is_alive():
-                    logging.error("Excavator is not alive, exiting")
-                    self.cleanup()
-                    return
+                self.excavator.submit(self.excavator.api.is_alive(), self.excavator_event("alive"))
 
                 try:
-                    self.paying_current = nicehash_api.multialgo_info()
+                    self.paying_current = self.paying_cache.get()
                 except urllib.error.HTTPError as err:
                     logging.warning('server error retrieving NiceHash stats: %s %s' % (err.code, err.reason))
                 except urllib.error.URLError as err:
@@ -660,17 +537,7 @@ class Driver:
                 except (json.decoder.JSONDecodeError, KeyError):
                     logging.warning('failed to parse NiceHash stats')
                 else:
-                    for device in self.devices:
-                        payrates = self.nicehash_mbtc_per_day(device, self.paying_current)
-
-                        best_algo = max(payrates.keys(), key=lambda algo: payrates[algo])
-                        current_algo = self.device_settings[device].current_algo
-
-                        best_pay = payrates[best_algo]
-                        current_pay = payrates[current_algo] if current_algo else 0.0
-
-                        if best_pay > current_pay * (1.0 + self.switching_threshold):
-                            self.device_settings[device].best_algo = best_algo
+                    self.select_algorithms()
                             
 
             # Apply device settings
@@ -679,47 +546,31 @@ class Driver:
                 if ds.enabled:
                     if ds.best_algo:
                         if ds.current_algo != ds.best_algo:
-                            payrates = self.nicehash_mbtc_per_day(device, self.paying_current)
-                            logging.info('Switching device %s to %s (%.2f mBTC/day)' % (device, ds.best_algo, payrates[ds.best_algo]))
+                            payrate = self.payrates_current[self.payrate_matrix.device_index[device], self.payrate_matrix.algo_index[ds.best_algo]]
+                            logging.info('Switching device %s to %s (%.2f mBTC/day)' % (device, ds.best_algo, payrate))
                             ds.current_speed = 0.0
                             ds.current_pay = 0.0
-                            self.ipc.publish({
-                                "type": "device.algo",
-                                "device_id": device,
-                                "device_uuid": ds.uuid,
-                                "algo": best_algo,
-                                "speed": ds.current_speed,
-                                "paying": ds.paying
-                            })
+                            self.publish_ipc_device(device, ds.best_algo)
 
                             self.publish_device(device)
 
                             if ds.running:
                                 self.free_device(device)
         
-                            self.dispatch_device(device, best_algo)
+                            self.dispatch_device(device, ds.best_algo)
 
                 else:
                     if ds.running:
                         logging.info("Disabling device %i" % (device))
                         ds.current_speed = 0.0
                         ds.current_pay = 0.0
-                        self.ipc.publish({
-                                "type": "device.algo",
-                                "device_id": device,
-                                "device_uuid": ds.uuid,
-                                "algo": None,
-                                "speed": ds.current_speed,
-                                "paying": ds.paying
-                            })
+                        self.publish_ipc_device(device, None)
                         self.publish_device(device)
 
                         self.free_device(device)
 
-
-            #sleep(UPDATE_INTERVAL)
-            sleep(0.1)
-
+            # Send this iteration's ipc state changes as one frame per client
+            self.ipc.flush()
 
 
 def parse_devices(spec):
@@ -764,6 +615,11 @@ if __name__ == '__main__':
 
     parser.add_argument("--overclock", "-o", help="initial overclocing strategy [file, db_best, db_search]")
     parser.add_argument("--overclock-file", "-f", help="overclocing spec file for file strategy")
+    parser.add_argument("--overclock-metric", help="what db_best maximizes: hashrate or efficiency (hashrate per watt, default: hashrate)", choices=["hashrate", "efficiency"], default="hashrate")
+    parser.add_argument("--clock-range", '-c', help='gpu clock offset range searched by db_search, example: [-50:10:150]')
+    parser.add_argument("--mem-range", help='memory clock offset range searched by db_search, example: [200:10:300]')
+    parser.add_argument("--power-range", help='power offset range searched by db_search, example: [-20:5:20]')
+    parser.add_argument("--oc-verify", help="interval [s] for checking applied overclock offsets against the hardware", type=float)
 
     args = parser.parse_args()
 
@@ -793,10 +649,22 @@ if __name__ == '__main__':
 
     if args.overclock == "db_best":
         oc_strategy = Driver.DeviceSettings.OcStrategy.DB_BEST
+        if not args.db:
+            parser.error("--overclock 'db_best' requires --db to be specified")
     if args.overclock == "db_search":
         oc_strategy = Driver.DeviceSettings.OcStrategy.DB_SEARCH
-
-    driver = Driver(args.address, args.region, benchmarks, devices, args.worker, oc_strategy, args.overclock_file, args.threshold, args.excavator, args.ipc_port, args.autostart, db, args.mqtt_host, args.mqtt_name)
+        if not args.db:
+            parser.error("--overclock 'db_search' requires --db to be specified")
+        if not (args.clock_range or args.mem_range or args.power_range):
+            parser.error("--overclock 'db_search' requires at least one of --clock-range, --mem-range and --power-range")
+
+    oc_search_dimensions = {
+        "gpu_clock": oc_search.parse_dimension(args.clock_range) if args.clock_range else None,
+        "mem_clock": oc_search.parse_dimension(args.mem_range) if args.mem_range else None,
+        "power": oc_search.parse_dimension(args.power_range) if args.power_range else None
+    }
+
+    driver = Driver(args.address, args.region, benchmarks, devices, args.worker, oc_strategy, args.overclock_file, args.threshold, args.excavator, args.ipc_port, args.autostart, db, args.mqtt_host, args.mqtt_name, args.oc_verify, args.overclock_metric, oc_search_dimensions)
     signal.signal(signal.SIGINT, sigint_handler)
 
     driver.run()
@@ -24,7 +24,6 @@ class Sensor():
     
     def set(self, val):
         self.value = val
-        print(self.name+": "+str(self.value))
 
     def get(self):
         return self.value
@@ -80,7 +79,8 @@ class WsServer(threading.Thread):
             self.msg_cb(json.loads(msg))
 
 class MinerMonitor():
-    def __init__(self):
+    def __init__(self, smi_rate=1.0):
+        """smi_rate -- gpu sampling rate [Hz]"""
 
         self.sensors = {}
         self.add_sensor(Sensor("t_water_hot", "Coolant hot"))
@@ -91,6 +91,8 @@ class MinerMonitor():
         self.queue = queue.Queue()
 
         self.running = True
+        self.smi_rate = smi_rate
+        self.sampler = None
 
         self.serial_port = None
         self.ws_server = WsServer(9090, self.process_json, self.ws_connected)
@@ -105,13 +107,21 @@ class MinerMonitor():
         devices = nvidia_smi.devices()
         for d in devices:
             self.add_sensor(Sensor("t_gpu."+str(d["id"]), "Gpu "+str(d["id"])))
+            self.add_sensor(Sensor("p_gpu."+str(d["id"]), "Gpu "+str(d["id"])+" power"))
+            self.add_sensor(Sensor("clk_gpu."+str(d["id"]), "Gpu "+str(d["id"])+" clock"))
+            self.add_sensor(Sensor("mem_clk_gpu."+str(d["id"]), "Gpu "+str(d["id"])+" memory clock"))
 
-        rate = 1
-        while self.running:
-            for d in devices:
-                temp = nvidia_smi.temperature(d["id"])
-                self.queue.put(("t_gpu."+str(d["id"]), temp))
-            time.sleep(1.0/rate)
+        # One nvidia-smi stream samples all gpus, a batch is queued as one item
+        def put(samples):
+            batch = []
+            for s in samples:
+                for key, field in [("t_gpu", "temp"), ("p_gpu", "power"), ("clk_gpu", "clock"), ("mem_clk_gpu", "mem_clock")]:
+                    if s[field] is not None:
+                        batch.append((key+"."+str(s["id"]), s[field]))
+            self.queue.put(batch)
+
+        self.sampler = nvidia_smi.Sampler(rate=self.smi_rate, sink=put)
+        self.sampler.start()
 
 
     def serial(self):
@@ -141,13 +151,16 @@ class MinerMonitor():
     def stop(self):
         print("Stopping")
         self.running = False
+        if self.sampler:
+            self.sampler.stop()
         self.ws_server.stop()
         self.excavator_driver.stop()
         self.http_server.stop()
 
     def join(self):
         print("Joining")
-        self.thread_smi.join()
+        if self.sampler:
+            self.sampler.join()
         print("b")
         self.thread_serial.join()
         print("c")
@@ -163,8 +176,7 @@ class MinerMonitor():
         self.thread_serial = threading.Thread(target=self.serial)
         self.thread_serial.start()
         
-        self.thread_smi = threading.Thread(target=self.smi)
-        self.thread_smi.start()
+        self.smi()
 
         self.ws_server.start()
         self.http_server.start()
@@ -190,7 +202,11 @@ class MinerMonitor():
             except queue.Empty:
                 continue
             
-            self.input(e[0], e[1])
+            if isinstance(e, list):
+                for key, value in e:
+                    self.input(key, value)
+            else:
+                self.input(e[0], e[1])
 
     def ws_connected(self, client):
             self.excavator_driver.message({"cmd": "publish.state"})
@@ -243,7 +259,8 @@ class MinerMonitor():
 
 if __name__ == "__main__":
 
-    monitor = MinerMonitor()
+    # usage: monitor.py [serial port] [gpu sampling rate]
+    monitor = MinerMonitor(float(sys.argv[2]) if len(sys.argv) > 2 else 1.0)
 
     try:
         monitor.run()
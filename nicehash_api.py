@@ -2,11 +2,21 @@ import requests, time, os, sys
 import logging
 import re
 import json
+import fcntl
+import socket
 
 import urllib.error
 import urllib.request
 
 NICEHASH_TIMEOUT = 20
+# The slowest poller (the driver's UPDATE_INTERVAL), so faster ones share its fetches
+PAYING_TTL = 30
+# Failed fetches fall back to older rates up to this age
+PAYING_MAX_STALE = 600
+PAYING_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "nicehash-tools", "paying.json")
+
+# Errors multialgo_info raises on network or parse failure
+NICEHASH_ERRORS = (urllib.error.URLError, socket.timeout, ValueError, KeyError)
 
 
 def multialgo_info():
@@ -23,5 +33,88 @@ def multialgo_info():
     return paying
 
 
+class PayingCache:
+    """Pay rate cache with a TTL, persisted to a json file.
+
+    Every local tool using the same file shares one fetch: the first one to
+    find the rates older than ttl fetches them under an exclusive lock, the
+    others pick up the result from the file. When a fetch fails the last good
+    rates are used while they are younger than max_stale, and age() tells
+    how old they are.
+    """
+
+    def __init__(self, filename=PAYING_CACHE, ttl=PAYING_TTL, fetch=multialgo_info, max_stale=PAYING_MAX_STALE):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.fetch = fetch
+
+        self.paying = None
+        self.timestamp = 0.0
+
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.load()
+
+    def age(self):
+        """Seconds since the cached rates were fetched, None if there are none."""
+        if self.paying is None:
+            return None
+        return time.time() - self.timestamp
+
+    def fresh(self):
+        return self.paying is not None and self.age() < self.ttl
+
+    def usable(self):
+        """True if there are rates younger than max_stale."""
+        return self.paying is not None and self.age() < self.max_stale
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+            if data["timestamp"] > self.timestamp:
+                self.paying = data["paying"]
+                self.timestamp = data["timestamp"]
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"timestamp": self.timestamp, "paying": self.paying}, f)
+        os.rename(tmp, self.filename)
+
+    def get(self):
+        """Returns the pay rates, fetching them if the cache is older than ttl.
+
+        A failed fetch falls back to the last good rates; the error is only
+        raised when there are none younger than max_stale.
+        """
+
+        if self.fresh():
+            return self.paying
+
+        with open(self.filename + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Another process may have fetched while we waited for the lock
+            self.load()
+            if self.fresh():
+                return self.paying
+
+            try:
+                paying = self.fetch()
+            except NICEHASH_ERRORS as e:
+                if not self.usable():
+                    raise
+                logging.warning('failed to retrieve NiceHash stats, using %.0f s old rates: %s', self.age(), e)
+                return self.paying
 
+            self.paying = paying
+            self.timestamp = time.time()
+            self.save()
 
+        return self.paying
@@ -17,12 +17,18 @@ from pprint import pprint
 from time import sleep
 
 class Monitor(threading.Thread):
-    def __init__(self, device_ids=None, data=["xidEvent","temp","procClk","pwrDraw","memClk","violPwr","violThm"]):
+    def __init__(self, device_ids=None, data=["xidEvent","temp","procClk","pwrDraw","memClk","violPwr","violThm"], sink=None):
+        """Streams nvidia-smi stats events.
+
+        sink -- optional callable receiving every event, used instead of the
+                internal queue so events can be merged with other sources
+        """
         threading.Thread.__init__(self)
         self.running = True
         self.queue = queue.Queue(maxsize=50)
         self.device_ids = device_ids
         self.data = data
+        self.sink = sink
         self.daemon = True
         self.proc = None
 
@@ -38,7 +44,12 @@ class Monitor(threading.Thread):
         self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
         while(self.running):
             line = self.proc.stdout.readline().decode("utf-8", errors='ignore')
-            if not self.running or len(line) == 0:
+            if len(line) == 0:
+                # nvidia-smi exited, stop instead of spinning on eof
+                self.proc.wait()
+                logging.warning("nvidia-smi stats exited (code: %s)", str(self.proc.returncode))
+                break
+            if not self.running:
                 continue
             parts = line.split(",")
             event = {
@@ -47,7 +58,10 @@ class Monitor(threading.Thread):
                 "time": int(parts[2]),
                 "value": int(parts[3])
             }
-            self.queue.put(event)
+            if self.sink:
+                self.sink(event)
+            else:
+                self.queue.put(event)
 
     def get_event(self, block=True, timeout=None):
         try:
@@ -58,7 +72,106 @@ class Monitor(threading.Thread):
     class Empty(queue.Empty):
         pass
 
-def devices():
+class Sampler(threading.Thread):
+    """Samples all gpus together from one long running nvidia-smi --query-gpu stream.
+
+    Every rate'th of a second sink (or the queue) receives a list with one
+    dict per gpu, containing "id" and the keys of fields. Since a single
+    nvidia-smi process samples all gpus, the rate holds regardless of the
+    number of gpus.
+    """
+
+    FIELDS = {
+        "temp": "temperature.gpu",
+        "power": "power.draw",
+        "clock": "clocks.sm",
+        "mem_clock": "clocks.mem"
+    }
+
+    def __init__(self, device_ids=None, rate=1.0, fields=["temp", "power", "clock", "mem_clock"], sink=None):
+        threading.Thread.__init__(self)
+        self.running = True
+        self.queue = queue.Queue(maxsize=50)
+        self.device_ids = device_ids
+        self.rate = rate
+        self.fields = fields
+        self.sink = sink
+        self.daemon = True
+        self.proc = None
+
+    def stop(self):
+        self.running = False
+        if self.proc:
+            self.proc.terminate()
+
+    def command(self):
+        cmd = ["nvidia-smi",
+            "--query-gpu=" + ",".join(["index"] + [self.FIELDS[f] for f in self.fields]),
+            "--format=csv,noheader,nounits",
+            "-lms", str(max(int(1000.0/self.rate), 1))]
+        if self.device_ids:
+            cmd += ["-i", ",".join(str(d) for d in self.device_ids)]
+        return cmd
+
+    def parse(self, line):
+        parts = [p.strip() for p in line.split(",")]
+        sample = {"id": int(parts[0])}
+        for field, value in zip(self.fields, parts[1:]):
+            try:
+                sample[field] = float(value)
+            except ValueError:
+                # [Not Supported] and the like
+                sample[field] = None
+        return sample
+
+    def run(self):
+        count = len(self.device_ids) if self.device_ids else len(devices())
+        self.proc = subprocess.Popen(self.command(), stdout=subprocess.PIPE)
+        batch = []
+        while(self.running):
+            line = self.proc.stdout.readline().decode("utf-8", errors='ignore')
+            if len(line) == 0:
+                self.proc.wait()
+                logging.warning("nvidia-smi query exited (code: %s)", str(self.proc.returncode))
+                break
+            if not self.running or len(line.strip()) == 0:
+                continue
+            try:
+                sample = self.parse(line)
+            except (ValueError, IndexError):
+                logging.warning("Skipping unexpected nvidia-smi query line: %s", line.strip())
+                continue
+            # A gpu seen twice means lines were lost, start over with the new interval
+            if any(s["id"] == sample["id"] for s in batch):
+                batch = []
+            batch.append(sample)
+            if len(batch) < count:
+                continue
+            if self.sink:
+                self.sink(batch)
+            else:
+                self.queue.put(batch)
+            batch = []
+
+    def get_samples(self, block=True, timeout=None):
+        try:
+            return self.queue.get(block=block, timeout=timeout)
+        except queue.Empty:
+            raise Monitor.Empty()
+
+# Device inventory, queried once per process
+_devices = None
+_devices_lock = threading.Lock()
+
+def devices(refresh=False):
+    """Returns the gpus listed by nvidia-smi -L, cached for the process lifetime."""
+    global _devices
+    with _devices_lock:
+        if _devices is None or refresh:
+            _devices = _list_devices()
+        return list(_devices)
+
+def _list_devices():
     devices = []
     proc = subprocess.run(["nvidia-smi", "-L"], stdout=subprocess.PIPE)
     for line in proc.stdout.decode("utf-8", errors='ignore').splitlines():
@@ -74,7 +187,7 @@ def device(device_id):
     for d in devices():
         if d["id"] == device_id:
             return d
-    return ValueError("Unknown gpu number: %i" % (device_id))
+    raise ValueError("Unknown gpu number: %i" % (device_id))
 
 def temperature(device_id):
     proc = subprocess.run(["nvidia-smi", "dmon", "-i", str(device_id), "-c", "1", "-s", "p"], stdout=subprocess.PIPE)
@@ -0,0 +1,224 @@
+import logging
+import re
+
+import overclock_session
+
+
+def parse_range(spec):
+
+    r_float = '[+-]?[0-9]*\.[0-9]+|[+-]?[0-9]+'
+    m_scalar = re.match(r"("+r_float+")", spec)
+    m_range = re.match(r"\[("+r_float+"):?("+r_float+")?:?("+r_float+")?\]", spec)
+
+    if(m_scalar):
+        return [float(m_scalar.group(1))]
+    elif(m_range):
+        first = float(m_range.group(1))
+        step = 1
+        last = first
+        if(m_range.group(3)):
+            last = float(m_range.group(3))
+            step = float(m_range.group(2))
+        elif(m_range.group(2)):
+            last = float(m_range.group(2))
+        return list(frange(first, last, step))
+    else:
+        raise Exception("Could not parse range: %s" % (spec))
+
+def frange(x, y, jump):
+    while x < y:
+        yield x
+        x += jump
+    yield y
+
+def parse_dimension(spec):
+    """Parses a range spec like [-50:10:150] to (low, high, step) for CoordinateSearch."""
+    values = parse_range(spec)
+    step = values[1] - values[0] if len(values) > 1 else 0
+    return (min(values), max(values), step)
+
+
+class CoordinateSearch:
+    """Coordinate descent over power, gpu clock and memory clock offsets.
+
+    Starting from stock settings (clipped to the bounds), the search steps up
+    and down one dimension at a time and keeps moving while the hashrate
+    improves by more than tolerance. When a full round over all dimensions
+    gives no improvement the steps are halved, and the search ends once every
+    step is at its minimum. A crashed benchmark should be reported as 0.
+
+    Usage: benchmark propose() and report() the result until propose()
+    returns None, then best() holds the result.
+    """
+
+    DIMENSIONS = ["power", "gpu_clock", "mem_clock"]
+
+    def __init__(self, dimensions, tolerance=0.005, max_evaluations=None, lookup=None):
+        """dimensions -- dict of name -> (low, high, step) for the dimensions to search
+        tolerance -- relative hashrate improvement needed to accept a move
+        max_evaluations -- stop after this many benchmarks
+        lookup -- optional callable(OcSpec) returning a known hashrate or None,
+                  used to reuse earlier samples instead of benchmarking
+        """
+
+        self.dimensions = dict((k, v) for k, v in dimensions.items() if v is not None)
+        self.tolerance = tolerance
+        self.max_evaluations = max_evaluations
+        self.lookup = lookup
+
+        # Offsets are applied as whole numbers, so steps and points are kept whole
+        self.steps = dict((k, int(round(v[2]))) for k, v in self.dimensions.items())
+        self.min_steps = dict((k, max(int(round(v[2] / 4.0)), 1) if v[2] else 0) for k, v in self.dimensions.items())
+
+        self.results = {}
+        self.evaluations = 0
+        self.reused = 0
+        self.best_point = None
+        self.best_value = None
+
+        self.pending = None
+        self.reply = None
+        self.done = False
+        self.search = self._search()
+
+    def spec(self, point):
+        values = dict(zip(self.DIMENSIONS, point))
+        return overclock_session.OcSpec(values["gpu_clock"], values["mem_clock"], values["power"])
+
+    def point(self, spec):
+        return tuple(getattr(spec, k) for k in self.DIMENSIONS)
+
+    def propose(self):
+        """Returns the next OcSpec to benchmark, or None when the search is finished."""
+        if self.done:
+            return None
+        if self.pending is None:
+            try:
+                self.pending = self.search.send(self.reply)
+            except StopIteration:
+                self.done = True
+                return None
+            self.reply = None
+        return self.spec(self.pending)
+
+    def report(self, spec, hashrate):
+        point = self.point(spec)
+        self.results[point] = hashrate
+        if point == self.pending:
+            self.evaluations += 1
+            self.reply = hashrate
+            self.pending = None
+
+    def best(self):
+        """Returns (OcSpec, hashrate) of the best point found so far, or (None, None)."""
+        if self.best_point is None:
+            return (None, None)
+        return (self.spec(self.best_point), self.best_value)
+
+    def _clip(self, name, value):
+        low, high, step = self.dimensions[name]
+        return int(round(min(max(value, low), high)))
+
+    def _move(self, point, name, delta):
+        i = self.DIMENSIONS.index(name)
+        moved = list(point)
+        moved[i] = self._clip(name, moved[i] + delta)
+        return tuple(moved)
+
+    def _evaluate(self, point):
+        if point not in self.results and self.lookup:
+            value = self.lookup(self.spec(point))
+            if value is not None:
+                self.reused += 1
+                self.results[point] = value
+        if point not in self.results:
+            yield point
+        return self.results[point]
+
+    def _better(self, value):
+        return value > self.best_value * (1.0 + self.tolerance)
+
+    def _search(self):
+        start = tuple(self._clip(k, 0) if k in self.dimensions else None for k in self.DIMENSIONS)
+        self.best_point = start
+        self.best_value = yield from self._evaluate(start)
+
+        while True:
+            improved = False
+            for name in self.dimensions:
+                for direction in [1, -1]:
+                    moved_along = False
+                    while True:
+                        if self.max_evaluations and self.evaluations >= self.max_evaluations:
+                            return
+                        candidate = self._move(self.best_point, name, direction * self.steps[name])
+                        if candidate == self.best_point:
+                            break
+                        value = yield from self._evaluate(candidate)
+                        if not self._better(value):
+                            break
+                        logging.info("Oc search: %s improved to %s (%s)", name, str(value), self.spec(candidate))
+                        self.best_point = candidate
+                        self.best_value = value
+                        improved = moved_along = True
+                    # No need to try the other direction after a successful move
+                    if moved_along:
+                        break
+
+            if not improved:
+                if all(self.steps[k] <= self.min_steps[k] for k in self.dimensions):
+                    return
+                for k in self.dimensions:
+                    self.steps[k] = max(int(round(self.steps[k] / 2.0)), self.min_steps[k])
+
+
+def more_aggressive(spec, crashed):
+    """True if spec has the same or higher clocks than crashed at the same or
+    lower power, so it can be expected to crash as well."""
+    value = lambda x: x or 0
+    return value(spec.gpu_clock) >= value(crashed.gpu_clock) and \
+        value(spec.mem_clock) >= value(crashed.mem_clock) and \
+        value(spec.power) <= value(crashed.power)
+
+def crashed_specs(database, gpu_uuid, algo):
+    """Returns the OcSpecs of all failed samples."""
+    return [overclock_session.OcSpec(s["gpu_clock_offset"], s["mem_clock_offset"], s["power_offset"])
+        for s in database.samples(gpu_uuid, algo, success=False)]
+
+def db_lookup(database, gpu_uuid, algo):
+    """Returns a CoordinateSearch lookup answering from earlier samples in database.
+
+    A point that ever failed, or is more aggressive than one that failed,
+    counts as 0, otherwise the mean hashrate is used.
+    """
+    def lookup(spec):
+        if any(more_aggressive(spec, c) for c in crashed_specs(database, gpu_uuid, algo)):
+            return 0.0
+        samples = database.near(gpu_uuid, algo, spec.power, spec.gpu_clock, spec.mem_clock)
+        if len(samples) == 0:
+            return None
+        if any(not s["success"] for s in samples):
+            return 0.0
+        return sum(s["hashrate"] for s in samples) / len(samples)
+    return lookup
+
+
+class OcStrategyDbSearch(overclock_session.OcStrategy):
+    """Benchmarks the next point of a CoordinateSearch in every session, and
+    uses the best point found once the search has finished."""
+
+    def __init__(self, device_uuid, algo, search):
+        overclock_session.OcStrategy.__init__(self, device_uuid, algo)
+        self.search = search
+        self.spec = None
+
+    def get_spec(self):
+        spec = self.search.propose()
+        if spec is None:
+            spec = self.search.best()[0] or overclock_session.OcSpec()
+        self.spec = spec
+        return spec
+
+    def add_result(self, hashrate, power_offset, gpu_clock_offset, mem_clock_offset):
+        if self.spec is not None and not self.search.done:
+            self.search.report(self.spec, hashrate)
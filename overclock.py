@@ -5,21 +5,76 @@ import re
 import json
 import tempfile
 import subprocess
+import contextlib
+import threading
 import xml.etree.ElementTree as ET
 
+import nvidia_smi
+
 class Device:
 
-    def __init__(self, number, dummy_xml = None):
+    def __init__(self, number, dummy_xml = None, debug_xml = None):
         self.logger = logging.getLogger(__name__)
         self.device_number = number
         self.dummy_xml = dummy_xml
-
+        self.debug_xml = debug_xml
+
+        self.data = None
+        self.snapshot = None
+
+        # Offsets applied through this object, None until known. Read-backs are
+        # served from here; only verify_offsets() asks the hardware.
+        self.offsets = {"clock": None, "memory": None, "power": None}
+        self.offsets_version = 0
+        self.offsets_lock = threading.Lock()
+
+    def _set_offset(self, name, value):
+        with self.offsets_lock:
+            self.offsets[name] = value
+            self.offsets_version += 1
+
+    def _get_offset(self, name, query):
+        with self.offsets_lock:
+            if self.offsets[name] is not None:
+                return self.offsets[name]
+            version = self.offsets_version
+
+        value = query()
+
+        with self.offsets_lock:
+            # Keep a value set while we were querying
+            if self.offsets_version == version:
+                self.offsets[name] = value
+            return self.offsets[name]
+
+    def verify_offsets(self):
+        """Reads clock, memory and power offsets from the hardware, returns the names that differed from the record."""
+        drifted = []
+        queries = [
+            ("clock", self.query_clock_offset),
+            ("memory", self.query_memory_offset),
+            ("power", self.read_power_offset)
+        ]
+        for name, query in queries:
+            with self.offsets_lock:
+                expected = self.offsets[name]
+                version = self.offsets_version
+
+            value = query()
+
+            with self.offsets_lock:
+                if self.offsets_version != version:
+                    continue
+                # Power limits are reported with two decimals
+                if expected is not None and abs(expected - value) > 0.01:
+                    self.logger.warning("[GPU-%d] %s offset is %s, expected %s", self.device_number, name, str(value), str(expected))
+                    drifted.append(name)
+                self.offsets[name] = value
+        return drifted
 
     def set_power(self, limit):
-        limit_default = self.get("gpu/power_readings/default_power_limit", tp = "W")
-        limit_min = self.get("gpu/power_readings/min_power_limit", tp = "W")
-        limit_max = self.get("gpu/power_readings/max_power_limit", tp = "W")
-
+        limit_min = self.snapshot.require("min_power_limit")
+        limit_max = self.snapshot.require("max_power_limit")
 
         self.logger.info("[GPU-%d] Setting power limit to: %f W", self.device_number, limit)
 
@@ -28,41 +83,58 @@ class Device:
         
         self.nvidia_smi(["-pl", str(limit)])
         #print(proc.returncode)
+        self._set_offset("power", limit - self.snapshot.require("default_power_limit"))
     
     def set_power_offset(self, offset):
-        limit_default = self.get("gpu/power_readings/default_power_limit", tp = "W")
+        limit_default = self.snapshot.require("default_power_limit")
         target = limit_default + offset
         self.set_power(target)
 
-    def set_clock_offset(self, offset):
-        self.set_performance_mode()
-        self.nvidia_settings(["-a", '[gpu:'+str(self.device_number)+']/GPUGraphicsClockOffset[3]='+str(int(offset))])
+    def set_clock_offset(self, offset, batch=None):
+        with SettingsBatch.use(batch) as b:
+            self.set_performance_mode(b)
+            b.add(self.device_number, 'GPUGraphicsClockOffset[3]', int(offset), lambda: self._set_offset("clock", int(offset)))
 
     def get_clock_offset(self):
+        return self._get_offset("clock", self.query_clock_offset)
+
+    def query_clock_offset(self):
         offset = int(self.nvidia_settings_get('GPUGraphicsClockOffset[3]'))
         return offset
 
-    def set_memory_offset(self, offset):
-        self.set_performance_mode()
-        self.nvidia_settings(["-a", '[gpu:'+str(self.device_number)+']/GPUMemoryTransferRateOffset[3]='+str(int(offset))])
+    def set_memory_offset(self, offset, batch=None):
+        with SettingsBatch.use(batch) as b:
+            self.set_performance_mode(b)
+            b.add(self.device_number, 'GPUMemoryTransferRateOffset[3]', int(offset), lambda: self._set_offset("memory", int(offset)))
 
     def get_memory_offset(self):
-        offset = int(self.nvidia_settings_get('GPUMemoryTransferRateOffset[2]'))
+        return self._get_offset("memory", self.query_memory_offset)
+
+    def query_memory_offset(self):
+        offset = int(self.nvidia_settings_get('GPUMemoryTransferRateOffset[3]'))
         return offset
 
     def get_temp(self):
-        return self.get("gpu/temperature/gpu_temp", tp = "C")
+        return self.snapshot.require("temperature")
 
     def get_power_limit(self):
-        return self.get("gpu/power_readings/power_limit", tp = "W")
+        return self.snapshot.require("power_limit")
 
     def get_power_offset(self):
+        return self._get_offset("power", self.query_power_offset)
+
+    def query_power_offset(self):
         limit = self.get_power_limit()
-        limit_default = self.get("gpu/power_readings/default_power_limit", tp = "W")
+        limit_default = self.snapshot.require("default_power_limit")
         return limit - limit_default
 
+    def read_power_offset(self):
+        """Like query_power_offset(), from a fresh nvidia-smi snapshot."""
+        self.refresh()
+        return self.query_power_offset()
+
     def get_uuid(self):
-        return self.get("gpu/uuid")
+        return self.snapshot.require("uuid")
 
     def nvidia_settings_get(self, var):
         proc = self.nvidia_settings(["-t", '-q', '[gpu:' + str(self.device_number) + ']/' + var])
@@ -73,22 +145,16 @@ class Device:
         
         return res
 
-    def set_performance_mode(self):
-        self.nvidia_settings(["-a", '[gpu:'+str(self.device_number)+']/GPUPowerMizerMode=1'])
+    def set_performance_mode(self, batch=None):
+        with SettingsBatch.use(batch) as b:
+            b.add(self.device_number, 'GPUPowerMizerMode', 1)
 
-    def unset_performance_mode(self):
-        self.nvidia_settings(["-a", '[gpu:'+str(self.device_number)+']/GPUPowerMizerMode=0'])
+    def unset_performance_mode(self, batch=None):
+        with SettingsBatch.use(batch) as b:
+            b.add(self.device_number, 'GPUPowerMizerMode', 0)
 
     def nvidia_settings(self, args):
-        cmd = ["nvidia-settings"] + args
-        self.logger.debug("Running: %s", cmd)
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE)
-        self.logger.debug("nvidia-settings: '%s'", proc.stdout.decode("utf-8", errors='ignore'))
-
-        if(proc.returncode != 0):
-            raise Exception("nvidia-settings exited with error %d" % (proc.returncode))
-        
-        return proc    
+        return nvidia_settings(args)
 
     def nvidia_smi(self, args):
         cmd = ["nvidia-smi", "-i", str(self.device_number)] + args
@@ -107,53 +173,218 @@ class Device:
         return proc
 
     def refresh(self):
-        self.data = self.query()
-        #for a in data.find("./gpu"):
-        #    print(a)
+        self.set_data(self.query())
+
+    def set_data(self, data):
+        self.data = data
+        self.snapshot = GpuSnapshot(data.find("gpu"))
 
     def get(self, key, tp = None):
         val = self.data.find(key).text
         if(val == "N/A"):
             raise NotSupportedException("Not supported: %s" % (key))
 
-        if(tp == "W"):
-            m = re.match(r"([0-9]*\.[0-9]+|[0-9]+) W", val)
-            return float(m.group(1))
-
-        elif(tp == "C"):
-            m = re.match(r"([0-9]*\.[0-9]+|[0-9]+) C", val)
-            return float(m.group(1))
-
+        if tp:
+            return parse_value(val, tp)
         else:
             return val
 
     def query(self):
 
         if self.dummy_xml:
-            return ET.parse(self.dummy_xml)
+            return ET.parse(self.dummy_xml).getroot()
+
+        return query_xml(["-i", str(self.device_number)], self.debug_xml)
+
+class GpuSnapshot:
+    """Values of one <gpu> element of nvidia-smi -q -x, parsed once.
+
+    Fields reported as N/A are None.
+    """
+
+    FIELDS = [
+        ("uuid", "uuid", None),
+        ("temperature", "temperature/gpu_temp", "C"),
+        ("power_draw", "power_readings/power_draw", "W"),
+        ("power_limit", "power_readings/power_limit", "W"),
+        ("default_power_limit", "power_readings/default_power_limit", "W"),
+        ("min_power_limit", "power_readings/min_power_limit", "W"),
+        ("max_power_limit", "power_readings/max_power_limit", "W"),
+    ]
+
+    def __init__(self, gpu):
+        for name, key, tp in self.FIELDS:
+            element = gpu.find(key)
+            val = None
+            if element is not None and element.text not in (None, "N/A"):
+                val = parse_value(element.text, tp) if tp else element.text
+            setattr(self, name, val)
+
+    def require(self, name):
+        val = getattr(self, name)
+        if val is None:
+            raise NotSupportedException("Not supported: %s" % (name))
+        return val
+
+class NotSupportedException(Exception):
+    pass
+
+
+class SettingsBatch:
+    """Collects nvidia-settings assignments and applies them in one invocation.
+
+    Assignments may target any number of gpus. Setting an attribute again
+    replaces the earlier value and moves it to the end, so assignments are
+    applied in the order they were last made. The callbacks of the remaining
+    assignments run once nvidia-settings succeeded.
+    """
 
-        proc = self.nvidia_smi(["-q", "-x"])
+    def __init__(self):
+        self.assignments = []
 
-        # Preprocess to remove process names with invalid characters
-        parsable = ""
+    @staticmethod
+    @contextlib.contextmanager
+    def use(batch=None):
+        """Yields batch, or a new batch that is committed on exit if batch is None."""
+        if batch is not None:
+            yield batch
+        else:
+            own = SettingsBatch()
+            yield own
+            own.commit()
+
+    def add(self, device_number, attribute, value, on_commit=None):
+        key = (device_number, attribute)
+        for i, (k, v, cb) in enumerate(self.assignments):
+            if k == key:
+                if v == value:
+                    if on_commit:
+                        self.assignments[i] = (k, v, on_commit)
+                    return
+                del self.assignments[i]
+                break
+        self.assignments.append((key, value, on_commit))
+
+    def commit(self):
+        if len(self.assignments) == 0:
+            return
+        args = []
+        for (device_number, attribute), value, cb in self.assignments:
+            args += ["-a", '[gpu:%d]/%s=%s' % (device_number, attribute, str(value))]
+        assignments = self.assignments
+        self.assignments = []
+        nvidia_settings(args)
+
+        for key, value, cb in assignments:
+            if cb:
+                cb()
+
+
+class Reconciler(threading.Thread):
+    """Periodically checks the recorded offsets of devices against the hardware."""
+
+    def __init__(self, devices, interval):
+        threading.Thread.__init__(self)
+        self.devices = list(devices)
+        self.interval = interval
+        self.daemon = True
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            for dev in self.devices:
+                try:
+                    dev.verify_offsets()
+                except Exception as e:
+                    logging.getLogger(__name__).warning("[GPU-%d] Could not verify offsets: %s", dev.device_number, str(e))
+
+
+def nvidia_settings(args):
+    logger = logging.getLogger(__name__)
+    cmd = ["nvidia-settings"] + args
+    logger.debug("Running: %s", cmd)
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE)
+    logger.debug("nvidia-settings: '%s'", proc.stdout.decode("utf-8", errors='ignore'))
+
+    if(proc.returncode != 0):
+        raise Exception("nvidia-settings exited with error %d" % (proc.returncode))
+
+    return proc
+
+
+def parse_value(val, tp):
+    """Parses a value with unit, like "180.00 W", to float."""
+    m = re.match(r"([0-9]*\.[0-9]+|[0-9]+) " + tp, val)
+    return float(m.group(1))
+
+def query_xml(args=[], debug_xml=None):
+    """Runs nvidia-smi -q -x and parses the output as it is streamed.
+
+    The <processes> sections are dropped before parsing, as process names may
+    contain characters that are invalid in xml.
+
+    debug_xml -- optional filename to write the filtered xml to
+    """
+
+    cmd = ["nvidia-smi"] + args + ["-q", "-x"]
+    logging.getLogger(__name__).debug("Running: %s", cmd)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+
+    parser = ET.XMLParser()
+    debug = open(debug_xml, "w") if debug_xml else None
+    try:
         in_processes = False
-        for line in proc.stdout.decode("utf-8", errors='ignore').splitlines():
+        for raw in proc.stdout:
+            line = raw.decode("utf-8", errors='ignore')
             if "<processes>" in line:
                 in_processes = True
             elif "</processes>" in line:
                 in_processes = False
             elif not in_processes:
-                parsable = parsable + line + "\n"
+                parser.feed(line)
+                if debug:
+                    debug.write(line)
+    finally:
+        if debug:
+            debug.close()
+        proc.stdout.close()
+        proc.wait()
 
-        # Write file for future ref        
-        with open("out.xml", "w") as f:
-            f.write(parsable)
+    if(proc.returncode != 0):
+        raise Exception("nvidia-smi exied with error %d" % (proc.returncode))
 
-        # Parse xml
-        return ET.fromstring(parsable)
+    return parser.close()
 
-class NotSupportedException(Exception):
-    pass
+def refresh_all(devices):
+    """Refreshes several devices from a single nvidia-smi -q -x call."""
+    devices = list(devices)
+    if len(devices) == 0:
+        return
+
+    if any(dev.dummy_xml for dev in devices):
+        for dev in devices:
+            dev.refresh()
+        return
+
+    # Device numbers are nvidia-smi indices, matched through the uuid inventory
+    root = query_xml()
+    gpus = dict((gpu.findtext("uuid", "").strip(), gpu) for gpu in root.findall("gpu"))
+
+    for dev in devices:
+        try:
+            uuid = nvidia_smi.device(dev.device_number)["uuid"]
+        except ValueError:
+            uuid = None
+        if uuid not in gpus:
+            # Not in the listing, ask for it by index
+            dev.refresh()
+            continue
+        data = ET.Element(root.tag)
+        data.append(gpus[uuid])
+        dev.set_data(data)
 
 
 
@@ -175,10 +406,11 @@ if(__name__ == "__main__"):
     parser.add_argument("--power", "-p", help='set the power limit [W]', type=float)
 
     parser.add_argument("--dummy-xml", type=str)
+    parser.add_argument("--debug-xml", help='write the queried xml to this file', type=str)
 
     args = parser.parse_args()
 
-    dev = Device(args.device, dummy_xml=args.dummy_xml)
+    dev = Device(args.device, dummy_xml=args.dummy_xml, debug_xml=args.debug_xml)
     dev.refresh()
 
     if(args.power != None):
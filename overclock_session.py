@@ -1,6 +1,7 @@
 import logging
 import overclock
 import time
+import math
 import json
 
 class OcSpec:
@@ -31,6 +32,10 @@ class OcStrategy:
     def refresh(self):
         pass
 
+    def add_result(self, hashrate, power_offset, gpu_clock_offset, mem_clock_offset):
+        """Called with every benchmark result the session saves for this device and algorithm."""
+        pass
+
 class OcStrategyStatic(OcStrategy):
     def __init__(self, device_uuid, algo, oc_spec):
         OcStrategy.__init__(self, device_uuid, algo)
@@ -68,6 +73,56 @@ class OcStrategyFile(OcStrategy):
 
         return spec
 
+class BestSpecIndex:
+    """In-memory index of the best overclock spec per (gpu uuid, algo).
+
+    Built once from the benchmark database and kept current with add().
+    """
+
+    HASHRATE = "hashrate"
+    EFFICIENCY = "efficiency"
+
+    def __init__(self, database, metric=HASHRATE, power_limits={}):
+        """metric -- HASHRATE, or EFFICIENCY for hashrate per watt of power limit
+        power_limits -- dict of gpu uuid -> default power limit [W], used by EFFICIENCY
+        """
+        self.metric = metric
+        self.power_limits = power_limits
+        self.best = {}
+
+        for s in database.samples(success=True):
+            self.add(s["gpu_uuid"], s["algo"], s["hashrate"], s["power_offset"], s["gpu_clock_offset"], s["mem_clock_offset"])
+
+    def score(self, gpu_uuid, hashrate, power_offset):
+        if self.metric == self.EFFICIENCY and gpu_uuid in self.power_limits:
+            return hashrate / (self.power_limits[gpu_uuid] + (power_offset or 0))
+        return hashrate
+
+    def add(self, gpu_uuid, algo, hashrate, power_offset, gpu_clock_offset, mem_clock_offset):
+        if not hashrate:
+            return
+        key = (gpu_uuid, algo)
+        score = self.score(gpu_uuid, hashrate, power_offset)
+        if key not in self.best or score > self.best[key][0]:
+            self.best[key] = (score, OcSpec(gpu_clock_offset, mem_clock_offset, power_offset))
+
+    def get(self, gpu_uuid, algo):
+        """Returns the best OcSpec, or None if the combination was never benchmarked."""
+        entry = self.best.get((gpu_uuid, algo))
+        return entry[1] if entry else None
+
+class OcStrategyDbBest(OcStrategy):
+    def __init__(self, device_uuid, algo, index):
+        OcStrategy.__init__(self, device_uuid, algo)
+        self.index = index
+
+    def get_spec(self):
+        spec = self.index.get(self.device_uuid, self.algo)
+        return spec if spec else OcSpec()
+
+    def add_result(self, hashrate, power_offset, gpu_clock_offset, mem_clock_offset):
+        self.index.add(self.device_uuid, self.algo, hashrate, power_offset, gpu_clock_offset, mem_clock_offset)
+
 class OcSession:
     class State:
         INACTIVE = "inactive"
@@ -75,32 +130,94 @@ class OcSession:
         WARMUP_2 = "warmup_2"
         ACTIVE = "active"
         FINISHING = "finishing"
+        CRASHED = "crashed"
 
     
     TIME_WARMUP_1 = 2
     TIME_WARMUP_2 = 20
     BENCHMARK_MIN_LENGTH = 100
-
-    def __init__(self, strategy, dev, database, excavator):
+    MINER_VERSION = "1.5.11"
+
+    # Hashrate convergence: 95% confidence interval half width relative to the
+    # mean. Excavator reports a moving average, so consecutive samples are
+    # correlated; the interval is built from the means of non-overlapping
+    # blocks longer than its averaging window, which are close to independent.
+    CONFIDENCE_BLOCK = 15
+    CONVERGENCE_MIN_BLOCKS = 5
+    # Student t 95% two sided quantiles for 1..30 degrees of freedom, normal beyond
+    T_95 = [12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23,
+        2.20, 2.18, 2.16, 2.14, 2.13, 2.12, 2.11, 2.10, 2.09, 2.09,
+        2.08, 2.07, 2.07, 2.06, 2.06, 2.06, 2.05, 2.05, 2.05, 2.04]
+
+    def __init__(self, strategy, dev, database, excavator, tolerance=None):
+        """tolerance -- relative confidence interval at which the benchmark counts
+                     as converged (see converged()), None to never converge"""
         
         self.strategy = strategy
         self.dev = dev
         self.applied_oc = OcSpec()
         self.database = database
         self.excavator = excavator
+        self.tolerance = tolerance
 
         self.avg_full = 0
+        self.reset_stats()
         self.benchmark_result = {
             "length": 0,
             "avg_full": 0,
-            "current_speed": 0
+            "current_speed": 0,
+            "samples": 0,
+            "confidence": None
         }
 
         self._set_state(self.State.INACTIVE)
         self.reset_timer()
     
-    def end(self):
-        self.set_finishing()
+    def end(self, batch=None):
+        self.set_finishing(batch)
+
+    def reset_stats(self):
+        self.n_samples = 0
+        # Time weighted speed sum of the current block
+        self.block_sum = 0.0
+        self.block_time = 0.0
+        # Welford running mean and variance of the block means
+        self.n_blocks = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add_sample(self, speed, time_step):
+        self.n_samples += 1
+        self.block_sum += speed * time_step
+        self.block_time += time_step
+        if self.block_time < self.CONFIDENCE_BLOCK:
+            return
+
+        block_mean = self.block_sum / self.block_time
+        self.block_sum = 0.0
+        self.block_time = 0.0
+
+        self.n_blocks += 1
+        delta = block_mean - self.mean
+        self.mean += delta / self.n_blocks
+        self.m2 += delta * (block_mean - self.mean)
+
+    def confidence(self):
+        """Returns the 95% confidence interval half width of the mean speed,
+        relative to the mean, or None before there are two full blocks."""
+        if self.n_blocks < 2 or self.mean <= 0:
+            return None
+        df = self.n_blocks - 1
+        t = self.T_95[df - 1] if df <= len(self.T_95) else 1.96
+        stddev = math.sqrt(self.m2 / df)
+        return t * stddev / math.sqrt(self.n_blocks) / self.mean
+
+    def converged(self):
+        """True when the mean speed is known within the tolerance."""
+        if self.tolerance is None or self.n_blocks < self.CONVERGENCE_MIN_BLOCKS:
+            return False
+        confidence = self.confidence()
+        return confidence is not None and confidence <= self.tolerance
 
     def reset_timer(self):
         self.state_time_start = time.time()
@@ -123,9 +240,10 @@ class OcSession:
         self._set_state(self.State.ACTIVE)
         self.excavator.device_speed_reset(self.strategy.device_uuid)
         self.reset_timer()
+        self.reset_stats()
         # Reset speed measurement?
 
-    def set_finishing(self):
+    def set_finishing(self, batch=None):
 
         # Write to db if state is ACTIVE
         dev_power = 0
@@ -147,23 +265,45 @@ class OcSession:
         except overclock.NotSupportedException:
             dev_power = 0
 
+        # A crashed session was recorded as failed by record_crash()
         if self.database and \
                 self.state == self.State.ACTIVE and \
-                self.benchmark_result["length"] > self.BENCHMARK_MIN_LENGTH:
+                (self.benchmark_result["length"] > self.BENCHMARK_MIN_LENGTH or self.converged()):
             logging.debug("Saving benchmark result: %s", str(self.benchmark_result))
             self.database.save(self.strategy.algo, 
                 self.strategy.device_uuid, 
-                "excavator", "1.5.11", 
+                "excavator", self.MINER_VERSION, 
                 self.benchmark_result["avg_full"], 
                 dev_power, 
                 dev_clock, 
                 dev_mem, 
                 True, 
-                self.benchmark_result["length"])
+                self.benchmark_result["length"],
+                self.benchmark_result["confidence"])
+            self.strategy.add_result(self.benchmark_result["avg_full"], dev_power, dev_clock, dev_mem)
 
         self._set_state(self.State.FINISHING)
         self.reset_timer()
-        self.reset_overclock()
+        self.reset_overclock(batch)
+
+    def record_crash(self):
+        """Records the applied overclock as failed, so it is not chosen again.
+        The session is left CRASHED, so end() does not save a result for it."""
+        if self.state == self.State.CRASHED:
+            return
+        self._set_state(self.State.CRASHED)
+        spec = self.applied_oc
+        if self.database:
+            self.database.save(self.strategy.algo,
+                self.strategy.device_uuid,
+                "excavator", self.MINER_VERSION,
+                0.0,
+                spec.power,
+                spec.gpu_clock,
+                spec.mem_clock,
+                False,
+                self.benchmark_result["length"])
+        self.strategy.add_result(0.0, spec.power, spec.gpu_clock, spec.mem_clock)
 
     def get_speeds(self):
         return self.benchmark_result["avg_full"]
@@ -180,10 +320,14 @@ class OcSession:
 
         self.avg_full = (self.avg_full * time_prev + current_speed * time_step) / time_cuml
 
+        self.add_sample(current_speed, time_step)
+
         self.benchmark_result = {
             "length": time_cuml,
             "avg_full": self.avg_full,
-            "current_speed": current_speed
+            "current_speed": current_speed,
+            "samples": self.n_samples,
+            "confidence": self.confidence()
         }
 
     def loop(self, current_speed):
@@ -200,7 +344,9 @@ class OcSession:
         if self.state == self.State.ACTIVE:
             self.loop_active(current_speed)
 
-    def overclock(self):
+    def overclock(self, batch=None):
+        """Applies the strategy's spec. nvidia-settings changes go to batch if given,
+        otherwise they are applied in a single nvidia-settings call."""
         self.strategy.refresh()
         spec = self.strategy.get_spec()
 
@@ -208,12 +354,13 @@ class OcSession:
 
         if not self.applied_oc.equals(spec):
 
-            if spec.gpu_clock:
-                self.dev.set_clock_offset(spec.gpu_clock)
-                logging.info("overclocking device %i, gpu_clock: %s" % (self.dev.device_number, str(spec.gpu_clock)))
-            if spec.mem_clock:
-                self.dev.set_memory_offset(spec.mem_clock)
-                logging.info("overclocking device %i, mem_clock: %s" % (self.dev.device_number, str(spec.mem_clock)))
+            with overclock.SettingsBatch.use(batch) as b:
+                if spec.gpu_clock:
+                    self.dev.set_clock_offset(spec.gpu_clock, b)
+                    logging.info("overclocking device %i, gpu_clock: %s" % (self.dev.device_number, str(spec.gpu_clock)))
+                if spec.mem_clock:
+                    self.dev.set_memory_offset(spec.mem_clock, b)
+                    logging.info("overclocking device %i, mem_clock: %s" % (self.dev.device_number, str(spec.mem_clock)))
             if spec.power:
                 try:
                     self.dev.set_power_offset(spec.power)
@@ -222,22 +369,23 @@ class OcSession:
                     pass
             self.applied_oc = spec
 
-    def reset_overclock(self):
+    def reset_overclock(self, batch=None):
         logging.info("[%s] Resetting Oc", self.strategy.device_uuid)
 
         # Reset overclocking
-        if self.applied_oc.gpu_clock:
-            self.dev.set_clock_offset(0)
-            logging.info("overclocking device %i, gpu_clock: %s" % (self.dev.device_number, str(0)))
-        if self.applied_oc.mem_clock:
-            self.dev.set_memory_offset(0)
-            logging.info("overclocking device %i, mem_clock: %s" % (self.dev.device_number, str(0)))
+        with overclock.SettingsBatch.use(batch) as b:
+            if self.applied_oc.gpu_clock:
+                self.dev.set_clock_offset(0, b)
+                logging.info("overclocking device %i, gpu_clock: %s" % (self.dev.device_number, str(0)))
+            if self.applied_oc.mem_clock:
+                self.dev.set_memory_offset(0, b)
+                logging.info("overclocking device %i, mem_clock: %s" % (self.dev.device_number, str(0)))
+            self.dev.unset_performance_mode(b)
         if self.applied_oc.power:
             try:
                 self.dev.set_power_offset(0)
                 logging.info("overclocking device %i, power: %s" % (self.dev.device_number, str(0)))
             except:
                 pass
-        self.dev.unset_performance_mode()
 
-        self.applied_oc = OcSpec()
\ No newline at end of file
+        self.applied_oc = OcSpec()
@@ -23,10 +23,11 @@ import sys
 import json
 import time
 import urllib.error
-import urllib.request
 from pprint import pprint
 from time import sleep
 
+import nicehash_api
+
 DEVICES = [0]
 
 # TODO Check if file exists
@@ -40,7 +41,6 @@ PROFIT_SWITCH_THRESHOLD = 0.02
 UPDATE_INTERVAL = 10
 
 EXCAVATOR_TIMEOUT = 10
-NICEHASH_TIMEOUT = 20
 
 
 excavator_mock_device = {}
@@ -57,19 +57,6 @@ class ExcavatorAPIError(ExcavatorError):
         self.response = response
         self.error = response['error']
 
-def nicehash_multialgo_info():
-    """Retrieves pay rates and connection ports for every algorithm from the NiceHash API."""
-    response = urllib.request.urlopen('https://api.nicehash.com/api?method=simplemultialgo.info',
-                                      None, NICEHASH_TIMEOUT)
-    query = json.loads(response.read().decode('ascii')) #json.load(response)
-    paying = {}
-    ports = {}
-    for algorithm in query['result']['simplemultialgo']:
-        name = algorithm['name']
-        paying[name] = float(algorithm['paying'])
-        ports[name] = int(algorithm['port'])
-    return paying, ports
-
 def nicehash_mbtc_per_day(device, paying):
     """Calculates the BTC/day amount for every algorithm.
 
@@ -150,9 +137,13 @@ def main():
     csvfile = "profitability-log_"+str(int(time.time()))+".csv"
     headers = None
 
+    # Shares fetches with the excavator driver and other tools on this host
+    paying_cache = nicehash_api.PayingCache()
+
     while True:
         try:
-            paying, ports = nicehash_multialgo_info()
+            paying = paying_cache.get()
+            ports = None
         except urllib.error.URLError as err:
             logging.warning('failed to retrieve NiceHash stats: %s' % err.reason)
         except urllib.error.HTTPError as err:
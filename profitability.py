@@ -0,0 +1,133 @@
+import sys
+import time
+import random
+
+import numpy as np
+
+SECONDS_PER_DAY = 24*60*60
+
+
+class PayrateMatrix:
+    """Device x algorithm hashrate matrix for bulk mBTC/day calculation.
+
+    Dual algorithms (like daggerhashimoto_decred) are expanded into one column
+    per component algorithm, so the pay rate of every algorithm on every device
+    is a single matrix-vector product with the NiceHash paying vector.
+    """
+
+    def __init__(self, benchmarks):
+        """benchmarks -- dict of device id -> {algo: speed, or [speeds] for dual algos}"""
+
+        self.devices = list(benchmarks.keys())
+        self.algos = sorted(set(a for bms in benchmarks.values() for a in bms.keys()))
+        self.components = sorted(set(c.lower() for a in self.algos for c in a.split('_')))
+
+        self.device_index = dict((d, i) for i, d in enumerate(self.devices))
+        self.algo_index = dict((a, i) for i, a in enumerate(self.algos))
+        component_index = dict((c, i) for i, c in enumerate(self.components))
+
+        self.hashrates = np.zeros((len(self.devices), len(self.algos), len(self.components)))
+        self.available = np.zeros((len(self.devices), len(self.algos)), dtype=bool)
+
+        for device, bms in benchmarks.items():
+            i = self.device_index[device]
+            for algo, speed in bms.items():
+                j = self.algo_index[algo]
+                speeds = speed if '_' in algo else [speed]
+                for component, s in zip(algo.split('_'), speeds):
+                    self.hashrates[i, j, component_index[component.lower()]] = s
+                self.available[i, j] = True
+
+    def paying_vector(self, paying):
+        """Converts NiceHash paying info to mBTC/day per H/s for every component algorithm."""
+        return np.array([paying.get(c, 0.0) for c in self.components])*SECONDS_PER_DAY*1e-11
+
+    def payrates(self, paying):
+        """Returns a devices x algorithms array of mBTC/day, -inf where not benchmarked."""
+        rates = self.hashrates.dot(self.paying_vector(paying))
+        return np.where(self.available, rates, -np.inf)
+
+    def device_payrates(self, device, paying):
+        """Returns dict of algo -> mBTC/day for one device."""
+        i = self.device_index[device]
+        rates = self.payrates(paying)[i]
+        return dict((a, rates[j]) for j, a in enumerate(self.algos) if self.available[i, j])
+
+    def select(self, paying, current_algos, threshold):
+        """Picks the most profitable algorithm for all devices at once.
+
+        paying -- algorithm pay information from NiceHash
+        current_algos -- current algorithm (or None) per device, in self.devices order
+        threshold -- switching threshold ratio
+
+        Returns (payrates, best_algos, switch) where switch[i] is True when
+        device i should move to best_algos[i].
+        """
+
+        rates = self.payrates(paying)
+        rows = np.arange(len(self.devices))
+
+        best = rates.argmax(axis=1)
+        best_pay = rates[rows, best]
+
+        current = np.array([self.algo_index.get(a, -1) for a in current_algos], dtype=int)
+        current_pay = np.where(current >= 0, rates[rows, current], 0.0)
+
+        switch = best_pay > current_pay*(1.0 + threshold)
+        best_algos = [self.algos[j] for j in best]
+
+        return rates, best_algos, switch
+
+
+def payrates_reference(benchmarks, device, paying):
+    """Per device dict based calculation, kept as a baseline for benchmark()."""
+    bms = benchmarks[device]
+    pay = lambda algo, speed: paying[algo.lower()]*speed*(24*60*60)*1e-11
+    def pay_benched(algo):
+        if '_' in algo:
+            return sum([pay(multi_algo, bms[algo][i]) for
+                        i, multi_algo in enumerate(algo.split('_'))])
+        else:
+            return pay(algo, bms[algo])
+
+    return dict([(algo, pay_benched(algo)) for algo in bms.keys()])
+
+
+def benchmark(devices=100, algos=40, rounds=50):
+    """Compares the dict based and matrix based switching decision."""
+    single = ["algo%02d" % i for i in range(algos - algos//4)]
+    dual = ["%s_%s" % (single[i], single[-i - 1]) for i in range(algos//4)]
+    paying = dict((a, random.uniform(0.0, 1.0)) for a in single)
+
+    benchmarks = {}
+    for d in range(devices):
+        bms = dict((a, random.uniform(1e6, 1e9)) for a in single)
+        for a in dual:
+            bms[a] = [random.uniform(1e6, 1e9), random.uniform(1e6, 1e9)]
+        benchmarks[d] = bms
+    current = [None]*devices
+
+    start = time.time()
+    for r in range(rounds):
+        for d in range(devices):
+            payrates = payrates_reference(benchmarks, d, paying)
+            best_algo = max(payrates.keys(), key=lambda algo: payrates[algo])
+    reference = (time.time() - start)/rounds
+
+    start = time.time()
+    matrix = PayrateMatrix(benchmarks)
+    setup = time.time() - start
+
+    start = time.time()
+    for r in range(rounds):
+        matrix.select(paying, current, 0.02)
+    vectorized = (time.time() - start)/rounds
+
+    print("%d devices x %d algorithms" % (devices, algos))
+    print("dict:   %8.3f ms/decision" % (reference*1e3))
+    print("matrix: %8.3f ms/decision (%.3f ms setup)" % (vectorized*1e3, setup*1e3))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
@@ -6,38 +6,77 @@ import time
 import threading
 import queue
 import requests
-import json
+import http.server
+
+import ipc_codec
 
-from http_parser.http import HttpStream
-from http_parser.reader import SocketReader
 
 class IpcServer(threading.Thread):
+    """Json over http ipc server.
+
+    Connections are kept alive (HTTP/1.1) and every connection is served by
+    its own thread, so slow clients do not block others. The handler thread
+    waits until the request is responded to from the consumer of the
+    request queue.
+
+    Bodies are json, or msgpack (when installed) for requests with that
+    Content-Type. Responses use the request's Content-Type.
+    """
+
+    REQUEST_TIMEOUT = 30.0
 
     class Request():
-        def __init__(self, cb, socket, path, method, headers, body):
+        def __init__(self, cb, socket, path, method, headers, data):
             self.cb = cb
             self.socket = socket
             self.path = path
             self.method = method
             self.header = headers
-            self.data = json.loads(body) if len(body) > 0 else None
+            self.data = data
             self.closed = False
         
         def respond(self, data=None):
             if not self.closed:
                 self.closed = True
-                d = json.dumps(data) if data else ""
-                self.cb(self.socket, d)
+                self.cb(self.socket, data if data else None)
 
     class Empty(queue.Empty):
         pass
 
+    class HttpServer(http.server.ThreadingHTTPServer):
+        allow_reuse_address = True
+        daemon_threads = True
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        server_version = "Simple-IPC-Server"
+
+        def setup(self):
+            http.server.BaseHTTPRequestHandler.setup(self)
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            self.server.ipc._handle_request(self)
+
+        do_GET = do_POST
+
+        def send_body(self, code, data, content_type=ipc_codec.JSON_CONTENT_TYPE):
+            self.send_response(code)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
     def __init__(self, port=8080):
         threading.Thread.__init__(self)
         self.host = "0.0.0.0"
         self.port = port
         self.requests = queue.Queue(maxsize=50)
         self.running = False
+        self.httpd = None
 
     def get_event(self, block=True, timeout=None):
         try:
@@ -47,115 +86,141 @@ class IpcServer(threading.Thread):
 
     def run(self):
         self.running = True
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         try:
             print("Starting ipc server on {host}:{port}".format(host=self.host, port=self.port))
-            self.socket.bind((self.host, self.port))
+            self.httpd = IpcServer.HttpServer((self.host, self.port), IpcServer.Handler)
+            self.httpd.ipc = self
 
         except Exception as e:
             print("Error: Could not bind to port {port}".format(port=self.port))
             raise e
 
-        try:
-            self._listen()
-        except:
-            if self.running:
-                raise
+        self.httpd.serve_forever(poll_interval=0.1)
+        self.httpd.server_close()
 
     def shutdown(self):
         print("Shutting down ipc server")
         self.running = False
+        if self.httpd:
+            self.httpd.shutdown()
 
-    def _generate_headers(self, response_code):
-        header = ''
-        if response_code == 200:
-            header += 'HTTP/1.1 200 OK\n'
-        else:
-            raise NotImplementedError()
-
-        tn = time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime())
-        header += 'Date: {now}\n'.format(now=tn)
-        header += 'Server: Simple-IPC-Server\n'
-        header += 'Connection: close\n\n'
-        return header
-
-    def _listen(self):
-        self.socket.settimeout(0.1)
-        self.socket.listen(5)
-        while self.running:
-            try:
-                (client, address) = self.socket.accept()
-                client.settimeout(1.0)
-                print("Recieved connection from {addr}".format(addr=address))
-                self._handle_client(client, address)
-            except socket.timeout:
-                continue
-        self.socket.shutdown()
-        self.socket.close()
-
-    def _respond(self, client, data):
-        resp = self._generate_headers(200)
-        resp += data
-        b = bytearray()
-        b.extend(map(ord, resp))
-        client.send(b)
-        client.close()
-
-    def _handle_client(self, client, address):
-        try:
-            
-            r = SocketReader(client)
-            p = HttpStream(r)
-            headers = p.headers()
-            body = ""
-            if "CONTENT-LENGTH" in headers and int(headers["CONTENT-LENGTH"]) > 0:
-                body = p.body_string(binary=False)
-
-            # System requests
-            if p.path() == "/alive":
-                self._respond(client, "ok")
-                return
-
-            # User requests
-            req = IpcServer.Request(self._respond, client, p.path(), p.method(), headers, body)
-            if p.path() == "/message":
-                req.respond()
-
-            self.requests.put(req)
+    def _handle_request(self, handler):
+        length = int(handler.headers.get("Content-Length", 0))
+        body = handler.rfile.read(length) if length > 0 else b""
 
-        except Exception as e:
-            client.close()
-            raise e
+        content_type = handler.headers.get("Content-Type", ipc_codec.JSON_CONTENT_TYPE)
+        if content_type != ipc_codec.MSGPACK_CONTENT_TYPE or not ipc_codec.msgpack:
+            content_type = ipc_codec.JSON_CONTENT_TYPE
+
+        # System requests
+        if handler.path == "/alive":
+            handler.send_body(200, b"ok")
+            return
+
+        # User requests, answered when the consumer responds
+        done = threading.Event()
+        response = []
+        def respond(h, data):
+            response.append(data)
+            done.set()
+
+        req = IpcServer.Request(respond, handler, handler.path, handler.command, handler.headers, ipc_codec.decode_body(body, content_type))
+        if handler.path == "/message":
+            req.respond()
+
+        self.requests.put(req)
+
+        if not done.wait(self.REQUEST_TIMEOUT):
+            req.closed = True
+            handler.send_body(503, b"")
+            return
+        handler.send_body(200, ipc_codec.encode_body(response[0], content_type), content_type)
 
 
 class IpcClient():
-    def __init__(self, address, port):
+    """Client for IpcServer, keeps a pool of persistent connections shared by all threads.
+
+    codec -- "json" or "msgpack" (requires the msgpack package) bodies
+    """
+
+    POOL_SIZE = 16
+
+    def __init__(self, address, port, codec="json"):
         self.address = address
         self.port = port
+        self.content_type = ipc_codec.MSGPACK_CONTENT_TYPE if codec == "msgpack" else ipc_codec.JSON_CONTENT_TYPE
+        self.session = requests.Session()
+        # Local ipc, skip proxy and netrc lookups on every request
+        self.session.trust_env = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE)
+        self.session.mount("http://", adapter)
     
     def _url(self, path):
         return 'http://'+self.address+':'+str(self.port)+path
 
     def is_alive(self):
         try:
-            r = requests.post(self._url('/alive'))
+            r = self.session.post(self._url('/alive'))
             if len(r.text) > 0:
                 return True
         except requests.exceptions.ConnectionError:
             return False
         return False
 
+    def _post(self, path, data):
+        return self.session.post(self._url(path), data=ipc_codec.encode_body(data, self.content_type), headers={"Content-Type": self.content_type})
+
     def message(self, data=None):
-        r = requests.post(self._url('/message'), json=data)
+        r = self._post('/message', data)
     
     def request(self, data=None):
-        r = requests.post(self._url('/request'), json=data)
-        if len(r.text):
-            return r.json()
-        else:
-            return None
+        r = self._post('/request', data)
+        return ipc_codec.decode_body(r.content, r.headers.get("Content-Type", ipc_codec.JSON_CONTENT_TYPE))
+
+    def close(self):
+        self.session.close()
+
+
+def load_test(port=8091, threads=8, duration=5.0, codec="json"):
+    """Runs request round trips from several threads against a local IpcServer, prints the sustained rate."""
+
+    server = IpcServer(port)
+    server.start()
+
+    def consume():
+        while server.running:
+            try:
+                r = server.get_event(timeout=0.1)
+            except IpcServer.Empty:
+                continue
+            r.respond({"data": r.data})
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+
+    client = IpcClient("localhost", port, codec)
+    while not client.is_alive():
+        time.sleep(0.1)
+
+    counts = [0] * threads
+    end = time.time() + duration
+    def worker(n):
+        while time.time() < end:
+            client.request({"n": n})
+            counts[n] += 1
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    print("%d threads, %s: %.0f requests/s" % (threads, codec, sum(counts) / duration))
+
+    client.close()
+    server.shutdown()
+    consumer.join()
+
 
 if __name__ == "__main__":
 
@@ -175,6 +240,12 @@ if __name__ == "__main__":
             client = IpcClient("localhost", 8080)
             resp = client.request({"batman": 77})
             print(resp)
+
+        # usage: simple_ipc.py load [threads] [seconds] [json|msgpack]
+        if sys.argv[1] == "load":
+            load_test(threads=int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+                duration=float(sys.argv[3]) if len(sys.argv) > 3 else 5.0,
+                codec=sys.argv[4] if len(sys.argv) > 4 else "json")
         
         sys.exit(0)
 
@@ -10,8 +10,11 @@ import subprocess
 import re
 import time
 import signal
+import threading
 import prctl
 
+import nvidia_smi
+
 # global process handle
 process = None
 
@@ -36,6 +39,45 @@ def get_temperature_nvidia():
         raise Exception("Could not read temperature")
     return max_temp
 
+class TemperatureStream():
+    """Max gpu temperature from one long running nvidia-smi stats process.
+
+    Sets hot as soon as a gpu reports a temperature above max_allowed. While
+    the stream has been silent for longer than STALE_TIMEOUT (or has died),
+    max_temperature() falls back to polling nvidia-smi dmon.
+    """
+
+    STALE_TIMEOUT = 5.0
+
+    def __init__(self, max_allowed):
+        self.max_allowed = max_allowed
+        self.temps = {}
+        self.last_event = time.time()
+        self.hot = threading.Event()
+        self.monitor = nvidia_smi.Monitor(data=["temp"], sink=self.event)
+
+    def start(self):
+        self.monitor.start()
+
+    def stop(self):
+        self.monitor.stop()
+
+    def event(self, event):
+        if event["type"] != "temp":
+            return
+        self.temps[event["id"]] = event["value"]
+        self.last_event = time.time()
+        if event["value"] > self.max_allowed:
+            self.hot.set()
+
+    def stale(self):
+        return not self.monitor.is_alive() or len(self.temps) == 0 or time.time() - self.last_event > self.STALE_TIMEOUT
+
+    def max_temperature(self):
+        if self.stale():
+            return get_temperature_nvidia()
+        return max(self.temps.values())
+
 def run(max_allowed, args):
     global process
 
@@ -45,22 +87,25 @@ def run(max_allowed, args):
         print("ERROR: Temperature above max limit, not staring (temp, max: %d, %d)" % (temp, max_allowed))
         return
 
+    stream = TemperatureStream(max_allowed)
+    stream.start()
+
     try:
         # Prctl ensures the subprocess gets KILL signal when super exits
         process = subprocess.Popen(args, preexec_fn=lambda: prctl.set_pdeathsig(signal.SIGKILL))
 
         while True:
-            temp = get_temperature_nvidia()
+            # Wakes up immediately on a temperature event above the limit
+            stream.hot.wait(timeout=1.0)
+            stream.hot.clear()
+            temp = stream.max_temperature()
 
             if(temp > max_allowed):      
                 print("ERROR: Temperature above max limit, killing process(temp, max: %d, %d)" % (temp, max_allowed))
                 kill(process)
 
-            try:
-                process.wait(timeout=1.0)
+            if process.poll() is not None:
                 return process.returncode
-            except subprocess.TimeoutExpired as e:
-                pass
     except KeyboardInterrupt as ki:
         kill(process, True)
 
@@ -69,6 +114,9 @@ def run(max_allowed, args):
         kill(process)
         raise(e)
 
+    finally:
+        stream.stop()
+
 def kill(proc, silent = False):
     if(proc):
         proc.kill()
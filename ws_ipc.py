@@ -1,14 +1,53 @@
+import asyncio
+import collections
+import sys
 import threading
 import websocket
 import websocket_server
 import queue
 import json
+
+import ipc_codec
+import socket
 import time
 
 
 class IpcException(Exception):
     pass
 
+def state_delta(base, current):
+    """Returns the changes from state base to current, both dicts of key -> dict.
+
+    Changed entries contain only the changed fields, removed entries are None.
+    A field removed from an entry is not expressed, the receiver keeps its
+    last value.
+    """
+    changes = {}
+    for key, value in current.items():
+        old = base.get(key)
+        if old is None:
+            changes[key] = value
+        else:
+            diff = dict((f, v) for f, v in value.items() if f not in old or old[f] != v)
+            if diff:
+                changes[key] = diff
+    for key in base:
+        if key not in current:
+            changes[key] = None
+    return changes
+
+def apply_delta(base, changes):
+    """Returns a new state with changes from state_delta() applied to base."""
+    state = dict((k, dict(v)) for k, v in base.items())
+    for key, value in changes.items():
+        if value is None:
+            state.pop(key, None)
+        elif key in state:
+            state[key].update(value)
+        else:
+            state[key] = dict(value)
+    return state
+
 class IpcPacket():
     def __init__(self, cb, client, id, data):
         self.cb = cb
@@ -23,13 +62,126 @@ class IpcPacket():
             self.cb(self, data if data else "")
 
 
+class ClientSender(threading.Thread):
+    """Sends frames to one client from its own thread, so a slow client
+    never blocks the thread publishing to it.
+
+    Frames with a kind are telemetry that supersede each other like state
+    updates: such a frame replaces a queued frame of the same kind (latest
+    wins), and when the queue is full the oldest one is dropped. Frames
+    without a kind, like responses, are never dropped. Frames are packet
+    dicts, encoded with the client's codec when sent. A frame put with a
+    codec switches to it, starting with that frame.
+    """
+
+    MAX_QUEUE = 64
+
+    def __init__(self, server, client, max_queue=MAX_QUEUE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.client = client
+        self.max_queue = max_queue
+        self.running = True
+
+        self.cond = threading.Condition()
+        self.frames = collections.deque()
+        self.codec = ipc_codec.JsonCodec()
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.dead = False
+
+        # Frames are small and latency sensitive
+        handler = client.get("handler")
+        if handler:
+            handler.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def put(self, frame, kind=None, codec=None):
+        with self.cond:
+            if self.dead:
+                self.dropped += 1
+                return
+            if kind is not None:
+                for i, (k, f, c) in enumerate(self.frames):
+                    if k == kind:
+                        self.frames[i] = (kind, frame, c)
+                        self.dropped += 1
+                        return
+            if len(self.frames) >= self.max_queue:
+                for i, (k, f, c) in enumerate(self.frames):
+                    if k is not None:
+                        del self.frames[i]
+                        self.dropped += 1
+                        break
+            self.frames.append((kind, frame, codec))
+            self.max_depth = max(self.max_depth, len(self.frames))
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "address": self.client["address"][0] if self.client.get("address") else None,
+                "queued": len(self.frames),
+                "max_queued": self.max_depth,
+                "codec": self.codec.name,
+                "sent": self.sent,
+                "sent_bytes": self.sent_bytes,
+                "dropped": self.dropped,
+                "dead": self.dead
+            }
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.frames:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                kind, frame, codec = self.frames.popleft()
+                if codec is not None:
+                    self.codec = codec
+            out = self.codec.encode(frame)
+            try:
+                self.server.send_message(self.client, out)
+            except (BrokenPipeError, ConnectionResetError, OSError):
+                with self.cond:
+                    self.dead = True
+                    self.frames.clear()
+                return
+            self.sent += 1
+            self.sent_bytes += len(out)
+
+
 class IpcServer(threading.Thread):
+    """Websocket ipc server.
+
+    Besides messages and request/response, the server holds a state of keyed
+    dicts set with update(). flush() sends each client one frame with the
+    changes since the last snapshot the client acknowledged, or the full
+    state to new clients.
+
+    Everything sent to a client goes through its ClientSender queue, the
+    calling thread never blocks on a client.
+    """
+
+    SNAPSHOT_HISTORY = 32
 
-    def __init__(self, port=8080):
+    def __init__(self, port=8080, sink=None):
+        """sink -- optional callable receiving every incoming packet, used instead
+                of the internal request queue
+        """
         threading.Thread.__init__(self)
         self.host = "0.0.0.0"
         self.port = port
         self.requests = queue.Queue(maxsize=50)
+        self.sink = sink
         self.running = False
         self.clients = []
 
@@ -40,6 +192,15 @@ class IpcServer(threading.Thread):
 
         self.next_id = 0
 
+        # Published state, snapshots by sequence number and per client ack
+        self.state_lock = threading.Lock()
+        self.state = {}
+        self.state_dirty = False
+        self.state_seq = 0
+        self.snapshots = collections.OrderedDict()
+        self.client_states = {}
+        self.senders = {}
+
     class Empty(queue.Empty):
         pass
 
@@ -49,6 +210,99 @@ class IpcServer(threading.Thread):
         except queue.Empty:
             raise IpcServer.Empty()
 
+    def update(self, key, data):
+        """Sets state entry key to the dict data, sent to clients on the next flush().
+
+        Deltas only add or change fields, a field left out of data keeps its
+        last value in clients' copies (see state_delta()).
+        """
+        with self.state_lock:
+            if self.state.get(key) != data:
+                self.state[key] = dict(data)
+                self.state_dirty = True
+
+    def remove(self, key):
+        with self.state_lock:
+            if key in self.state:
+                del self.state[key]
+                self.state_dirty = True
+
+    def flush(self):
+        """Sends the state changes since the last flush to all clients, one frame per client."""
+        with self.state_lock:
+            if self.state_dirty:
+                self.state_dirty = False
+                self.state_seq += 1
+                self.snapshots[self.state_seq] = dict((k, dict(v)) for k, v in self.state.items())
+                self.__trim_snapshots()
+
+            for client in self.clients:
+                cs = self.client_states[client["id"]]
+                if cs["sent"] == self.state_seq:
+                    continue
+                cs["sent"] = self.state_seq
+                # Queued under the lock, so an older frame never replaces a newer one
+                self.__send(client, self.__state_frame(cs["acked"]), "state")
+
+    def send_full(self, client):
+        """Sends the full state to client, e.g. when it asks for it."""
+        with self.state_lock:
+            if self.state_seq == 0:
+                return
+            self.__send(client, self.__state_frame(None), "state")
+
+    def stats(self):
+        """Returns dict of client id -> send queue statistics."""
+        with self.state_lock:
+            senders = list(self.senders.items())
+        return dict((client_id, sender.stats()) for client_id, sender in senders)
+
+    def __send(self, client, frame, kind=None):
+        sender = self.senders.get(client["id"])
+        if sender:
+            sender.put(frame, kind)
+
+    def __trim_snapshots(self):
+        # Keep the snapshots clients may still use as base
+        acked = [cs["acked"] for cs in self.client_states.values() if cs["acked"] is not None]
+        oldest = min(acked) if acked else self.state_seq
+        while len(self.snapshots) > 1:
+            seq = next(iter(self.snapshots))
+            if seq >= oldest and len(self.snapshots) <= self.SNAPSHOT_HISTORY:
+                break
+            del self.snapshots[seq]
+
+    def __state_frame(self, base):
+        current = self.snapshots[self.state_seq]
+        if base in self.snapshots:
+            changes = state_delta(self.snapshots[base], current)
+        else:
+            base = None
+            changes = current
+        return {
+                "type": "state",
+                "id": self.__next_id(),
+                "data": {
+                    "seq": self.state_seq,
+                    "base": base,
+                    "changes": changes
+                }
+            }
+
+    def __hello(self, packet):
+        # The client offers codecs in order of preference, the response is
+        # the first packet in the chosen codec
+        name = ipc_codec.negotiate(packet.data.get("codecs", []))
+        sender = self.senders.get(packet.client["id"])
+        if sender:
+            sender.put({"type": "response", "id": packet.id, "data": {"codec": name}}, codec=ipc_codec.create(name))
+
+    def __ack(self, client, seq):
+        with self.state_lock:
+            cs = self.client_states.get(client["id"])
+            if cs and (cs["acked"] is None or seq > cs["acked"]):
+                cs["acked"] = seq
+
     def __next_id(self):
         self.next_id += 1
         return self.next_id
@@ -59,67 +313,128 @@ class IpcServer(threading.Thread):
     
     def stop(self):
         self.running = False
+        for sender in list(self.senders.values()):
+            sender.stop()
         self.server.shutdown()
         print("ipc shutdown done")
 
     def connected(self, client, server):
         print("Got client")
-        self.clients.append(client)
+        sender = ClientSender(self.server, client)
+        sender.start()
+        with self.state_lock:
+            self.client_states[client["id"]] = {"acked": None, "sent": self.state_seq}
+            self.senders[client["id"]] = sender
+            self.clients.append(client)
+        # New clients start from the full state
+        self.send_full(client)
 
     def disconnected(self, client, server):
-        self.clients = [x for x in self.clients if x["id"] != client["id"]]
+        with self.state_lock:
+            self.clients = [x for x in self.clients if x["id"] != client["id"]]
+            self.client_states.pop(client["id"], None)
+            sender = self.senders.pop(client["id"], None)
+        if sender:
+            sender.stop()
 
     def publish(self, msg):
-        out = json.dumps(
-            {
+        out = {
                 "type": "message",
                 "id": self.__next_id(),
                 "data": msg
             }
-        )
-        self.server.send_message_to_all(out)
+        with self.state_lock:
+            clients = list(self.clients)
+        for client in clients:
+            self.__send(client, out)
 
     def __respond(self, packet, data={}):
-        out = json.dumps(
-            {
+        out = {
                 "type": "response",
                 "id": packet.id,
                 "data": data
             }
-        )
-        self.server.send_message(packet.client, out)
+        self.__send(packet.client, out)
 
     def received(self, client, server, msg):
-        print("Got message/request")
         deserialized = json.loads(msg)
-        print(deserialized)
         packet = IpcPacket(self.__respond, client, deserialized["id"], deserialized["data"])
 
         if deserialized["type"] != "request":
             packet.closed = True
 
         # Handle internal packets
-        if deserialized["type"] == "alive":
-            print("Responding to alive")
+        if deserialized["type"] == "ack":
+            self.__ack(client, deserialized["data"]["seq"])
+        elif deserialized["type"] == "hello":
+            self.__hello(packet)
+        elif deserialized["type"] == "alive":
             self.__respond(packet)
-            print("Done responding to alive")
+        elif self.sink:
+            self.sink(packet)
         else:
             self.requests.put(packet)
 
 
+class PendingRequest():
+    """A request waiting for its response, in a thread or an asyncio loop."""
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.event = None if loop else threading.Event()
+        self.future = loop.create_future() if loop else None
+        self.data = None
+
+    def resolve(self, data):
+        self.data = data
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._set_result, data)
+        else:
+            self.event.set()
+
+    def _set_result(self, data):
+        if not self.future.done():
+            self.future.set_result(data)
+
+
 class IpcClient(threading.Thread):
-    def __init__(self, address, port, on_connected=None):
+    """Websocket ipc client.
+
+    Mirrors the server state, and queues every changed state entry as a
+    message like the server had published it.
+
+    Requests may be made from any number of threads (request()) or asyncio
+    tasks (request_async()) at once, responses are matched by id.
+
+    codecs -- codec names (see ipc_codec) to offer the server on connect,
+              in order of preference. Packets to the server are always json.
+              The default json is cheapest to encode, compact only pays
+              off for clients on slow remote links.
+    """
+
+    SNAPSHOT_HISTORY = 32
+
+    def __init__(self, address, port, on_connected=None, codecs=None):
         threading.Thread.__init__(self)
         self.address = address
         self.port = port
-        #self.ws = websocket.WebSocket()
+        self.ws = None
         self.requests_out = {}
+        self.lock = threading.Lock()
         self.running = False
         self.messages = queue.Queue(maxsize=50)
         self.on_connected = on_connected
+        self.codecs = codecs
+        self.codec = ipc_codec.JsonCodec.name
+        self.decoder = ipc_codec.CompactCodec()
+        self.hello_id = None
 
         self.next_id = 0
 
+        # Mirrored state, snapshots by sequence number
+        self.state = {}
+        self.snapshots = collections.OrderedDict()
+
     class Empty(queue.Empty):
         pass
 
@@ -131,8 +446,9 @@ class IpcClient(threading.Thread):
             raise IpcClient.Empty()
 
     def __next_id(self):
-        self.next_id += 1
-        return self.next_id
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
 
     def run(self):
         self.ws = websocket.WebSocketApp("ws://"+self.address+":" + str(self.port) + "/",
@@ -155,17 +471,54 @@ class IpcClient(threading.Thread):
 
     def connected(self, ws):
         print("IPC Client connected")
+        # String ids of the compact codec are per connection
+        self.decoder = ipc_codec.CompactCodec()
+        self.codec = ipc_codec.JsonCodec.name
+        if self.codecs:
+            self.hello_id = self.__next_id()
+            self.__send("hello", self.hello_id, {"codecs": self.codecs})
         self.messages.put({"ipc": "connected"})
 
     def received(self, ws, data):
-        print(str(threading.get_ident())+" client received data: "+data)
-        parsed = json.loads(data)
-        if parsed["type"] == "response" and parsed["id"] in self.requests_out:
-            self.requests_out[parsed["id"]][1] = parsed["data"]
-            self.requests_out[parsed["id"]][0].set()
+        parsed = self.decoder.decode(data)
+        if parsed["type"] == "state":
+            self.received_state(parsed["data"])
+        elif parsed["type"] == "response" and parsed["id"] == self.hello_id:
+            self.codec = parsed["data"]["codec"]
+        elif parsed["type"] == "response":
+            with self.lock:
+                pending = self.requests_out.pop(parsed["id"], None)
+            # Responses to requests that timed out are dropped
+            if pending:
+                pending.resolve(parsed["data"])
         else:
             self.messages.put(parsed["data"])
 
+
+    def received_state(self, frame):
+        base = frame["base"]
+        if base is None:
+            # Full state, all entries are queued
+            self.snapshots.clear()
+            self.state = apply_delta({}, frame["changes"])
+            changes = self.state
+        else:
+            if base not in self.snapshots:
+                print("Ipc client missing state snapshot %d" % (base))
+                return
+            previous = self.state
+            self.state = apply_delta(self.snapshots[base], frame["changes"])
+            changes = state_delta(previous, self.state)
+
+        self.snapshots[frame["seq"]] = self.state
+        while len(self.snapshots) > self.SNAPSHOT_HISTORY or next(iter(self.snapshots)) < (base or frame["seq"]):
+            self.snapshots.popitem(last=False)
+
+        self.send("ack", {"seq": frame["seq"]})
+
+        for key, value in changes.items():
+            if value is not None:
+                self.messages.put(self.state[key])
         
     def stop(self):
         self.running = False
@@ -175,58 +528,123 @@ class IpcClient(threading.Thread):
         #self.ws.close()
 
     def message(self, msg):
-        out = json.dumps(
-            {
-                "type": "message",
-                "id": self.__next_id(),
-                "data": msg
-            }
-        )
+        self.send("message", msg)
+
+    def send(self, pct_type, msg):
         try:
-            self.ws.send(out)
-        except websocket._exceptions.WebSocketConnectionClosedException:
+            self.__send(pct_type, self.__next_id(), msg)
+        except IpcException:
             print("Ipc client not connected")
 
-    def request(self, data, timeout=None, pct_type="request"):
-        seq = self.__next_id()
+    def __send(self, pct_type, seq, msg):
         out = json.dumps(
             {
                 "type": pct_type,
                 "id": seq,
-                "data": data
+                "data": msg
             }
         )
         try:
+            if self.ws is None:
+                raise websocket._exceptions.WebSocketConnectionClosedException()
             self.ws.send(out)
         except websocket._exceptions.WebSocketConnectionClosedException:
             raise IpcException("Ipc client not connected")
 
-        # Block until received
-        ev = threading.Event()
-        self.requests_out[seq] = [ev, None]
-        print(str(threading.get_ident())+" waiting for event "+str(seq))
-        o = ev.wait(timeout=timeout)
-        print(str(threading.get_ident())+" o "+str(o))
-        print(str(threading.get_ident())+" deleting event "+str(seq))
-        p = self.requests_out[seq]
-        del self.requests_out[seq]
-        if o:
-            out = p[1]
-            return out
-        else:
+    def __register(self, pending):
+        # Registered before sending, the response may arrive before send returns
+        seq = self.__next_id()
+        with self.lock:
+            self.requests_out[seq] = pending
+        return seq
+
+    def __unregister(self, seq):
+        with self.lock:
+            self.requests_out.pop(seq, None)
+
+    def request(self, data, timeout=None, pct_type="request"):
+        """Sends a request and blocks until the response arrives, returns the response data."""
+        pending = PendingRequest()
+        seq = self.__register(pending)
+        try:
+            self.__send(pct_type, seq, data)
+            if not pending.event.wait(timeout=timeout):
+                raise IpcException("Timeout waiting for request response")
+        finally:
+            self.__unregister(seq)
+        return pending.data
+
+    async def request_async(self, data, timeout=None, pct_type="request"):
+        """Like request(), awaitable from an asyncio event loop."""
+        pending = PendingRequest(asyncio.get_running_loop())
+        seq = self.__register(pending)
+        try:
+            self.__send(pct_type, seq, data)
+            return await asyncio.wait_for(pending.future, timeout)
+        except asyncio.TimeoutError:
             raise IpcException("Timeout waiting for request response")
+        finally:
+            self.__unregister(seq)
 
     def is_alive(self):
         try:
-            print(str(threading.get_ident())+" Før alive wait")
-            resp = self.request({}, pct_type="alive", timeout=1.0)
-            print(str(threading.get_ident())+" Etter alive wait")
-        except websocket._exceptions.WebSocketConnectionClosedException:
+            self.request({}, pct_type="alive", timeout=1.0)
+        except IpcException:
             return False
         return True
 
+
+def benchmark(port=8090, count=2000, threads=8, concurrency=64):
+    """Measures request round trips per second against a local IpcServer."""
+
+    server = IpcServer(port, sink=lambda packet: packet.respond(packet.data))
+    client = IpcClient("localhost", port)
+    server.start()
+    client.start()
+    while not client.is_alive():
+        time.sleep(0.1)
+
+    def run(name, fn):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        print("%-12s %8.0f requests/s" % (name, count / elapsed))
+
+    def sequential():
+        for i in range(count):
+            client.request(i, timeout=5.0)
+
+    def threaded():
+        def worker(n):
+            for i in range(n):
+                client.request(i, timeout=5.0)
+        workers = [threading.Thread(target=worker, args=(count // threads,)) for t in range(threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+    def asynchronous():
+        async def batch():
+            for i in range(0, count, concurrency):
+                await asyncio.gather(*[client.request_async(j, timeout=5.0) for j in range(i, min(i + concurrency, count))])
+        asyncio.run(batch())
+
+    try:
+        run("sequential", sequential)
+        run("threads", threaded)
+        run("asyncio", asynchronous)
+    finally:
+        client.stop()
+        server.stop()
+
+
 if __name__ == "__main__":
 
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
+        sys.exit(0)
+
     port = 8080
 
     server = IpcServer(port)